@@ -0,0 +1,183 @@
+import asyncio
+import os
+import signal
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from pdf2txt import convert_pdf_to_txt
+
+EXTRACTION_WORKERS = int(os.getenv("EXTRACTION_WORKERS", str(os.cpu_count() or 1)))
+EXTRACTION_TIMEOUT = float(os.getenv("EXTRACTION_TIMEOUT", "60"))  # per document
+EXTRACTION_MAX_PENDING = int(os.getenv("EXTRACTION_MAX_PENDING", "1000"))
+JOB_RETENTION = float(os.getenv("JOB_RETENTION", "3600"))  # keep finished jobs
+# A worker dying (a crashing parser, the OOM killer) breaks the whole pool and
+# every job running in it. The pool is replaced and those jobs get one more
+# go, so only a document that kills its worker again is failed.
+CRASH_RETRIES = 1
+
+
+class ExtractionTimeout(Exception):
+    pass
+
+
+def _on_alarm(signum, frame):
+    raise ExtractionTimeout()
+
+
+def extract_text(
+    content: bytes, timeout: float, analyze: Optional[Callable[[str], Any]] = None
+) -> Tuple[str, Any]:
+    # Runs in the worker process, the alarm stops a stuck parse there so the
+    # worker is free for the next document. analyze gets the text there too,
+    # so CPU heavy work on it stays off the event loop.
+    if hasattr(signal, "setitimer"):
+        signal.signal(signal.SIGALRM, _on_alarm)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        text = convert_pdf_to_txt(content)
+        return text, analyze(text) if analyze is not None else None
+    finally:
+        if hasattr(signal, "setitimer"):
+            signal.setitimer(signal.ITIMER_REAL, 0)
+
+
+class ExtractionPipeline:
+    def __init__(
+        self,
+        workers: int = EXTRACTION_WORKERS,
+        timeout: float = EXTRACTION_TIMEOUT,
+        max_pending: int = EXTRACTION_MAX_PENDING,
+        analyze: Optional[Callable[[str], Any]] = None,
+    ):
+        self.workers = workers
+        # Module level function applied to each text in the worker
+        self.analyze = analyze
+        self.timeout = timeout
+        self.max_pending = max_pending
+        self.jobs: Dict[str, dict] = {}
+        self.pending = 0
+        self.restarts = 0
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+
+    def _start(self):
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            # Jobs only reach the pool when a worker is free, so the timeout
+            # covers the parse and not time spent waiting in the queue
+            self._slots = asyncio.Semaphore(self.workers)
+
+    def _replace_executor(self, broken: ProcessPoolExecutor):
+        # The first job to see the broken pool replaces it, the rest retry
+        # on the new one
+        if self._executor is broken:
+            broken.shutdown(wait=False, cancel_futures=True)
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            self.restarts += 1
+
+    async def _extract(self, content: bytes) -> Tuple[str, Any]:
+        loop = asyncio.get_running_loop()
+        for attempt in range(CRASH_RETRIES + 1):
+            executor = self._executor
+            if executor is None:
+                raise RuntimeError("Extraction pipeline is shut down")
+            future = loop.run_in_executor(
+                executor, extract_text, content, self.timeout, self.analyze
+            )
+            try:
+                # Small grace period, the worker's own alarm fires first
+                return await asyncio.wait_for(future, self.timeout + 5)
+            except BrokenProcessPool:
+                self._replace_executor(executor)
+                if attempt == CRASH_RETRIES:
+                    raise
+
+    def _prune(self):
+        cutoff = time.time() - JOB_RETENTION
+        for job_id in [
+            job_id
+            for job_id, job in self.jobs.items()
+            if job["finished_at"] and job["finished_at"] < cutoff
+        ]:
+            del self.jobs[job_id]
+
+    def submit(
+        self,
+        owner: str,
+        pdf_id: str,
+        content: bytes,
+        on_done: Callable[[str, Any], None],
+    ) -> Optional[dict]:
+        """Queue a document, returns None when the pipeline is full."""
+        if self.pending >= self.max_pending:
+            return None
+        self._start()
+        self._prune()
+
+        job = {
+            "job_id": uuid.uuid4().hex,
+            "owner": owner,
+            "pdf_id": pdf_id,
+            "status": "queued",
+            "submitted_at": time.time(),
+            "started_at": None,
+            "finished_at": None,
+            "error": None,
+        }
+        self.jobs[job["job_id"]] = job
+        self.pending += 1
+        asyncio.get_running_loop().create_task(self._run(job, content, on_done))
+        return job
+
+    async def _run(
+        self, job: dict, content: bytes, on_done: Callable[[str, Any], None]
+    ):
+        try:
+            async with self._slots:
+                job["status"] = "running"
+                job["started_at"] = time.time()
+                # content is kept for a retry on a fresh pool
+                text, analysis = await self._extract(content)
+            on_done(text, analysis)
+            job["status"] = "done"
+        except (ExtractionTimeout, asyncio.TimeoutError):
+            job["status"] = "timed_out"
+            job["error"] = f"Extraction took longer than {self.timeout:g}s"
+        except BrokenProcessPool:
+            job["status"] = "failed"
+            job["error"] = "The extraction worker crashed on this document"
+        except Exception as e:
+            job["status"] = "failed"
+            job["error"] = str(e)
+        finally:
+            job["finished_at"] = time.time()
+            self.pending -= 1
+
+    def get(self, job_id: str, owner: str) -> Optional[dict]:
+        job = self.jobs.get(job_id)
+        if job is None or job["owner"] != owner:
+            return None
+        return job
+
+    def stats(self, owner: Optional[str] = None) -> dict:
+        """Jobs by status, only owner's jobs when one is given."""
+        counts: Dict[str, int] = {}
+        for job in self.jobs.values():
+            if owner is None or job["owner"] == owner:
+                counts[job["status"]] = counts.get(job["status"], 0) + 1
+        if owner is not None:
+            return {"jobs": counts}
+        return {
+            "workers": self.workers,
+            "pending": self.pending,
+            "restarts": self.restarts,
+            "jobs": counts,
+        }
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
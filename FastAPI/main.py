@@ -5,11 +5,30 @@ from typing import Dict
 import jwt
 import datetime
 import mysql.connector
-from pdf2txt import convert_pdf_to_txt
+from extraction import ExtractionPipeline
+from search import SearchIndex, term_frequencies
 import base64
+import uuid
 
 app = FastAPI()
 
+# Text extraction runs in a process pool so parsing never blocks the event loop,
+# the search terms are counted there as well
+extraction = ExtractionPipeline(analyze=term_frequencies)
+# Per-user BM25 index over extracted text, compacted in the background
+search_index = SearchIndex()
+
+
+@app.on_event("startup")
+async def start_search_index():
+    search_index.start()
+
+
+@app.on_event("shutdown")
+def stop_extraction():
+    extraction.shutdown()
+    search_index.stop()
+
 # Mock MySQL connection (in production, use proper connection pooling)
 db = {"users": {}, "pdfs": {}}
 
@@ -77,17 +96,42 @@ async def upload_pdf(
         raise HTTPException(status_code=400, detail="Only PDF files are allowed")
 
     content = await file.read()
-    text_content = convert_pdf_to_txt(content)
 
-    pdf_id = f"{current_user}_{len(db['pdfs'].get(current_user, {}))}"
+    # Random so ids never repeat, even across restarts
+    pdf_id = f"{current_user}_{uuid.uuid4().hex[:12]}"
+    record = {"filename": file.filename, "content": None}
+
+    def store_text(text: str, frequencies: Dict[str, int]):
+        record["content"] = text
+        for term, tf in term_frequencies(file.filename).items():
+            frequencies[term] = frequencies.get(term, 0) + tf
+        search_index.add(current_user, pdf_id, frequencies)
+
+    job = extraction.submit(current_user, pdf_id, content, store_text)
+    if job is None:
+        raise HTTPException(status_code=503, detail="Too many PDFs being processed")
+
     if current_user not in db["pdfs"]:
         db["pdfs"][current_user] = {}
-
-    db["pdfs"][current_user][pdf_id] = {
-        "filename": file.filename,
-        "content": text_content,
+    record["job_id"] = job["job_id"]
+    db["pdfs"][current_user][pdf_id] = record
+    return {
+        "message": "PDF uploaded, text extraction queued",
+        "pdf_id": pdf_id,
+        "job_id": job["job_id"],
     }
-    return {"message": "PDF uploaded successfully", "pdf_id": pdf_id}
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str, current_user: str = Depends(get_current_user)):
+    job = extraction.get(job_id, current_user)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    response = {key: value for key, value in job.items() if key != "owner"}
+    if job["status"] == "done":
+        response["result"] = db["pdfs"][current_user][job["pdf_id"]]["content"]
+    return response
 
 
 @app.get("/pdfs")
@@ -99,15 +143,34 @@ async def get_pdfs(current_user: str = Depends(get_current_user)):
     ]
 
 
+@app.get("/pdfs/search")
+async def search_pdfs(
+    q: str, limit: int = 20, current_user: str = Depends(get_current_user)
+):
+    user_pdfs = db["pdfs"].get(current_user, {})
+    return [
+        {"pdf_id": pdf_id, "filename": user_pdfs[pdf_id]["filename"], "score": score}
+        for pdf_id, score in search_index.search(current_user, q, min(limit, 100))
+        if pdf_id in user_pdfs
+    ]
+
+
 @app.get("/pdf/{pdf_id}")
 async def get_pdf(pdf_id: str, current_user: str = Depends(get_current_user)):
     if current_user not in db["pdfs"] or pdf_id not in db["pdfs"][current_user]:
         raise HTTPException(status_code=404, detail="PDF not found")
 
+    # content stays None until the extraction job for this pdf is done
     pdf_data = db["pdfs"][current_user][pdf_id]
     return pdf_data
 
 
+@app.get("/jobs")
+async def extraction_stats(current_user: str = Depends(get_current_user)):
+    # Only the caller's own jobs, other users' uploads aren't theirs to see
+    return extraction.stats(current_user)
+
+
 """
 from fastapi import FastAPI, HTTPException, Depends
 from typing import Annotated
@@ -0,0 +1,163 @@
+import asyncio
+import heapq
+import math
+import os
+import re
+import threading
+from collections import Counter
+from typing import Dict, List, Set
+
+# The index lives in memory like the document store it covers, and is built
+# up again as documents are extracted. Term frequencies are computed by the
+# caller (the extraction worker), so only dictionary updates happen under
+# the lock on the event loop.
+SEARCH_MAINTENANCE_INTERVAL = float(os.getenv("SEARCH_MAINTENANCE_INTERVAL", "30"))
+# Compact a user's postings once this share of their documents is deleted
+SEARCH_COMPACT_RATIO = float(os.getenv("SEARCH_COMPACT_RATIO", "0.2"))
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+STOPWORDS = frozenset(
+    "a an and are as at be by for from has in is it of on or that the to was "
+    "were will with".split()
+)
+
+
+def tokenize(text: str) -> List[str]:
+    return [
+        token
+        for token in TOKEN_RE.findall(text.lower())
+        if len(token) > 1 and token not in STOPWORDS
+    ]
+
+
+def term_frequencies(text: str) -> Dict[str, int]:
+    return dict(Counter(tokenize(text)))
+
+
+class UserIndex:
+    """Postings for one user's documents, term -> {doc_id: term frequency}."""
+
+    def __init__(self):
+        self.postings: Dict[str, Dict[str, int]] = {}
+        self.doc_lengths: Dict[str, int] = {}
+        self.total_length = 0
+        self.deleted: Set[str] = set()
+
+    def add(self, doc_id: str, frequencies: Dict[str, int]):
+        if doc_id in self.doc_lengths:
+            self.remove(doc_id)
+            self.compact()
+        self.deleted.discard(doc_id)
+        for term, tf in frequencies.items():
+            self.postings.setdefault(term, {})[doc_id] = tf
+        length = sum(frequencies.values())
+        self.doc_lengths[doc_id] = length
+        self.total_length += length
+
+    def remove(self, doc_id: str):
+        # Postings are cleaned up lazily by compact()
+        length = self.doc_lengths.pop(doc_id, None)
+        if length is not None:
+            self.total_length -= length
+            self.deleted.add(doc_id)
+
+    def needs_compaction(self) -> bool:
+        live = max(len(self.doc_lengths), 1)
+        return bool(self.deleted) and len(self.deleted) >= SEARCH_COMPACT_RATIO * live
+
+    def compact(self):
+        if not self.deleted:
+            return
+        deleted = self.deleted
+        for term in list(self.postings):
+            docs = self.postings[term]
+            for doc_id in deleted.intersection(docs):
+                del docs[doc_id]
+            if not docs:
+                del self.postings[term]
+        self.deleted = set()
+
+    def search(self, terms: List[str], limit: int) -> List[tuple]:
+        doc_count = len(self.doc_lengths)
+        if not doc_count:
+            return []
+        average_length = self.total_length / doc_count
+        # BM25 with the per-query constants hoisted out of the postings loop
+        length_free = BM25_K1 * (1 - BM25_B)
+        length_weight = BM25_K1 * BM25_B / average_length
+        doc_lengths = self.doc_lengths
+        scores: Dict[str, float] = {}
+        for term in set(terms):
+            docs = self.postings.get(term)
+            if not docs:
+                continue
+            frequency = len(docs)
+            if self.deleted:
+                frequency -= sum(1 for doc_id in self.deleted if doc_id in docs)
+            idf = math.log(1 + (doc_count - frequency + 0.5) / (frequency + 0.5))
+            weight = idf * (BM25_K1 + 1)
+            for doc_id, tf in docs.items():
+                length = doc_lengths.get(doc_id)
+                if length is None:
+                    continue
+                scores[doc_id] = scores.get(doc_id, 0.0) + weight * tf / (
+                    tf + length_free + length_weight * length
+                )
+        return heapq.nlargest(limit, scores.items(), key=lambda item: item[1])
+
+
+class SearchIndex:
+    def __init__(self):
+        self.users: Dict[str, UserIndex] = {}
+        # Held while mutating and while compacting from a worker thread
+        self._lock = threading.Lock()
+        self._task = None
+
+    def add(self, owner: str, doc_id: str, frequencies: Dict[str, int]):
+        """Index a document from its term_frequencies()."""
+        with self._lock:
+            self.users.setdefault(owner, UserIndex()).add(doc_id, frequencies)
+
+    def remove(self, owner: str, doc_id: str):
+        with self._lock:
+            index = self.users.get(owner)
+            if index is not None:
+                index.remove(doc_id)
+
+    def search(self, owner: str, query: str, limit: int = 20) -> List[tuple]:
+        terms = tokenize(query)
+        with self._lock:
+            index = self.users.get(owner)
+            if index is None or not terms:
+                return []
+            return index.search(terms, limit)
+
+    def compact(self):
+        with self._lock:
+            for index in self.users.values():
+                if index.needs_compaction():
+                    index.compact()
+
+    async def _maintain(self):
+        while True:
+            await asyncio.sleep(SEARCH_MAINTENANCE_INTERVAL)
+            await asyncio.to_thread(self.compact)
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._maintain())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "users": len(self.users),
+                "documents": sum(len(i.doc_lengths) for i in self.users.values()),
+                "terms": sum(len(i.postings) for i in self.users.values()),
+            }
@@ -0,0 +1,441 @@
+import asyncio
+import atexit
+import contextlib
+import contextvars
+import datetime
+import decimal
+import enum
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import Integer, event, insert, inspect, select
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import NO_VALUE
+
+import models
+from database import engine
+from logger import get_logger
+
+log = get_logger("audit")
+
+# "async" queues the changes when the transaction commits and a background
+# thread writes them in bulk, "sync" inserts them in the same transaction as
+# the changes themselves, so neither can be committed without the other.
+AUDIT_DURABILITY = os.getenv("AUDIT_DURABILITY", "async")
+AUDIT_BATCH_SIZE = int(os.getenv("AUDIT_BATCH_SIZE", "500"))
+AUDIT_FLUSH_INTERVAL = float(os.getenv("AUDIT_FLUSH_INTERVAL", "1"))  # seconds
+AUDIT_QUEUE_SIZE = int(os.getenv("AUDIT_QUEUE_SIZE", "10000"))
+WRITE_ATTEMPTS = 3
+# Columns never copied into admin_changes, per table
+EXCLUDED_COLUMNS = {"users": frozenset({"password_hash"})}
+
+# Set by get_admin_user for the rest of the request, flushes made while it's
+# unset (ordinary users, startup, CLIs) aren't audited. Core statements skip
+# the flush hook, code issuing them calls record() or insert_rows() itself.
+current_admin: contextvars.ContextVar[Optional[int]] = contextvars.ContextVar(
+    "current_admin", default=None
+)
+# Audit rows captured so far in the current admin request, see watch()
+_captured: contextvars.ContextVar[Optional[List[int]]] = contextvars.ContextVar(
+    "audit_captured", default=None
+)
+unaudited_requests = 0
+
+_STOP = object()
+_record_keys: Dict[object, Optional[str]] = {}
+
+
+def record_key(mapper) -> Optional[str]:
+    """Attribute holding the row id, None for tables that aren't audited."""
+    if mapper not in _record_keys:
+        key = None
+        primary_key = mapper.primary_key
+        # record_id is an integer, composite and string keys can't be stored
+        if (
+            mapper.local_table.name != models.AdminChange.__tablename__
+            and len(primary_key) == 1
+            and isinstance(primary_key[0].type, Integer)
+        ):
+            key = mapper.get_property_by_column(primary_key[0]).key
+        _record_keys[mapper] = key
+    return _record_keys[mapper]
+
+
+def json_value(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    if isinstance(value, enum.Enum):
+        return value.value
+    if isinstance(value, bytes):
+        return f"<{len(value)} bytes>"
+    return value
+
+
+def redact(table: str, values: Optional[dict]) -> Optional[dict]:
+    excluded = EXCLUDED_COLUMNS.get(table)
+    if not excluded or values is None:
+        return values
+    return {key: value for key, value in values.items() if key not in excluded}
+
+
+def snapshot(state) -> dict:
+    # Only what's loaded, server defaults haven't been read back yet
+    return redact(
+        state.mapper.local_table.name,
+        {
+            attr.key: json_value(state.dict[attr.key])
+            for attr in state.mapper.column_attrs
+            if attr.key in state.dict
+        },
+    )
+
+
+def unloaded_changes(state) -> list:
+    """Changed attributes whose previous value was never loaded."""
+    return [
+        attr
+        for attr in state.mapper.column_attrs
+        if state.committed_state.get(attr.key, None) is NO_VALUE
+    ]
+
+
+def diff(state, loaded: Optional[dict] = None):
+    # loaded has the old values load_old_values read for unloaded attributes
+    excluded = EXCLUDED_COLUMNS.get(state.mapper.local_table.name, ())
+    old, new = {}, {}
+    for attr in state.mapper.column_attrs:
+        if attr.key in excluded:
+            continue
+        history = state.attrs[attr.key].history
+        if not history.added:
+            continue
+        if history.deleted:
+            before = history.deleted[0]
+        elif loaded is not None and attr.key in loaded:
+            before = loaded[attr.key]
+        else:
+            # Never loaded, None would claim a previous value it didn't have
+            continue
+        after = history.added[0]
+        if before != after:
+            old[attr.key] = json_value(before)
+            new[attr.key] = json_value(after)
+    return old, new
+
+
+@event.listens_for(Session, "before_flush")
+def load_old_values(session, flush_context, instances):
+    # Attributes set after a commit expired them have no old value in their
+    # history, read those before the flush overwrites them
+    if current_admin.get() is None:
+        return
+    loaded = {}
+    for obj in session.dirty:
+        state = inspect(obj)
+        if record_key(state.mapper) is None or state.identity is None:
+            continue
+        attrs = unloaded_changes(state)
+        if not attrs:
+            continue
+        primary_key = state.mapper.primary_key[0]
+        row = (
+            session.connection()
+            .execute(
+                select(*(attr.columns[0] for attr in attrs)).where(
+                    primary_key == state.identity[0]
+                )
+            )
+            .first()
+        )
+        if row is not None:
+            loaded[state] = {attr.key: value for attr, value in zip(attrs, row)}
+    if loaded:
+        session.info["audit_loaded"] = loaded
+
+
+@event.listens_for(Session, "after_flush")
+def capture_changes(session, flush_context):
+    # History is still in its pre-flush state here and new rows have their ids
+    loaded = session.info.pop("audit_loaded", {})
+    admin_id = current_admin.get()
+    if admin_id is None:
+        return
+    now = datetime.datetime.utcnow()
+    rows = []
+    changes = (
+        ("create", session.new),
+        ("update", session.dirty),
+        ("delete", session.deleted),
+    )
+    for change_type, objects in changes:
+        for obj in objects:
+            state = inspect(obj)
+            key = record_key(state.mapper)
+            if key is None:
+                continue
+            if change_type == "update":
+                old, new = diff(state, loaded.get(state))
+                if not new:
+                    continue
+            elif change_type == "create":
+                old, new = None, snapshot(state)
+            else:
+                old, new = snapshot(state), None
+            record_id = state.dict.get(key)
+            if record_id is None and state.identity:
+                record_id = state.identity[0]
+            rows.append(
+                audit_row(
+                    admin_id,
+                    change_type,
+                    now,
+                    state.mapper.local_table.name,
+                    record_id,
+                    old,
+                    new,
+                )
+            )
+    store(session, rows)
+
+
+def audit_row(admin_id, change_type, changed_at, table, record_id, old, new):
+    return {
+        "admin_id": admin_id,
+        "change_type": change_type,
+        "changed_at": changed_at,
+        "table_affected": table,
+        "record_id": record_id,
+        "old_value": old,
+        "new_value": new,
+    }
+
+
+def store(session, rows: List[dict]):
+    if not rows:
+        return
+    if AUDIT_DURABILITY == "sync":
+        session.connection().execute(insert(models.AdminChange), rows)
+        count_captured(len(rows))
+    else:
+        session.info.setdefault("audit_rows", []).extend(rows)
+
+
+def count_captured(count: int):
+    captured = _captured.get()
+    if captured is not None:
+        captured[0] += count
+
+
+def record(
+    session,
+    model,
+    change_type: str,
+    changes: Iterable[Tuple[int, Optional[dict], Optional[dict]]],
+):
+    """Audit (record_id, old, new) changes a Core statement made to model's table.
+
+    Takes a sync Session, async code goes through AsyncSession.run_sync.
+    """
+    admin_id = current_admin.get()
+    if admin_id is None:
+        return
+    now = datetime.datetime.utcnow()
+    table = model.__table__.name
+    rows = []
+    for record_id, old, new in changes:
+        old, new = redact(table, old), redact(table, new)
+        rows.append(audit_row(admin_id, change_type, now, table, record_id, old, new))
+    store(session, rows)
+
+
+def insert_rows(session, model, rows: List[dict]):
+    """Core executemany insert of rows, audited when an admin is making it."""
+    if current_admin.get() is None:
+        session.execute(insert(model), rows)
+        return
+    connection = session.connection()
+    key = model.__mapper__.primary_key[0]
+    if connection.dialect.insert_executemany_returning_sort_by_parameter_order:
+        statement = insert(model).returning(key, sort_by_parameter_order=True)
+        ids = session.execute(statement, rows).scalars().all()
+    else:
+        # MySQL can't return ids from a multi row insert, each row reports its
+        # own. Only admin requests pay for this.
+        ids = [
+            session.execute(insert(model), row).inserted_primary_key[0]
+            for row in rows
+        ]
+    # record() drops the excluded columns
+    record(
+        session,
+        model,
+        "create",
+        (
+            (record_id, None, {k: json_value(v) for k, v in row.items()})
+            for record_id, row in zip(ids, rows)
+        ),
+    )
+
+
+@contextlib.contextmanager
+def watch(action: str):
+    """Warn when an admin request changing data leaves no audit rows behind."""
+    global unaudited_requests
+    captured = [0]
+    _captured.set(captured)
+    yield
+    if not captured[0]:
+        unaudited_requests += 1
+        log.warning("Admin request %s recorded no changes", action)
+
+
+@event.listens_for(Session, "after_commit")
+def queue_changes(session):
+    rows = session.info.pop("audit_rows", None)
+    if rows:
+        count_captured(len(rows))
+        writer.submit(rows)
+
+
+@event.listens_for(Session, "after_rollback")
+def drop_changes(session):
+    session.info.pop("audit_rows", None)
+
+
+class AuditWriter:
+    """Background thread writing queued audit rows in bulk inserts."""
+
+    def __init__(
+        self,
+        batch_size: int = AUDIT_BATCH_SIZE,
+        interval: float = AUDIT_FLUSH_INTERVAL,
+        max_queued: int = AUDIT_QUEUE_SIZE,
+    ):
+        self.batch_size = batch_size
+        self.interval = interval
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queued)
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._overflow: Optional[ThreadPoolExecutor] = None
+        self.written = 0
+        self.batches = 0
+        self.failed = 0
+        self.overflow = 0
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="audit-writer", daemon=True
+                )
+                self._thread.start()
+                atexit.register(self.stop)
+
+    def submit(self, rows: List[dict]):
+        self.start()
+        for i, row in enumerate(rows):
+            try:
+                self._queue.put_nowait(row)
+            except queue.Full:
+                # The writer is behind, the rows are written straight away
+                # rather than dropped or blocking with the queue full
+                self.overflow += len(rows) - i
+                self._write_overflow(rows[i:])
+                return
+
+    def _write_overflow(self, rows: List[dict]):
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            # A worker thread, writing here slows its caller down, which is
+            # the backpressure we want
+            self._write(rows)
+            return
+        # Commits of async sessions land here on the event loop, which must
+        # not wait on the database
+        with self._lock:
+            if self._overflow is None:
+                self._overflow = ThreadPoolExecutor(1, "audit-overflow")
+            self._overflow.submit(self._write, rows)
+
+    def _run(self):
+        while True:
+            row = self._queue.get()
+            stopping = row is _STOP
+            batch = [] if stopping else [row]
+            deadline = time.monotonic() + self.interval
+            while not stopping and len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    row = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if row is _STOP:
+                    stopping = True
+                else:
+                    batch.append(row)
+            if batch:
+                self._write(batch)
+            for _ in range(len(batch) + stopping):
+                self._queue.task_done()
+            if stopping:
+                return
+
+    def _write(self, rows: List[dict]):
+        for attempt in range(WRITE_ATTEMPTS):
+            try:
+                with engine.begin() as connection:
+                    connection.execute(insert(models.AdminChange), rows)
+            except SQLAlchemyError:
+                if attempt == WRITE_ATTEMPTS - 1:
+                    self.failed += len(rows)
+                    log.exception("Dropped %d audit rows", len(rows))
+                    return
+                time.sleep(0.1 * 2**attempt)
+            else:
+                self.written += len(rows)
+                self.batches += 1
+                return
+
+    def flush(self):
+        """Block until everything queued so far is written."""
+        if self._thread is not None:
+            self._queue.join()
+        overflow = self._overflow
+        if overflow is not None:
+            # One thread, so this runs after the overflow writes before it
+            overflow.submit(lambda: None).result()
+
+    def stop(self):
+        with self._lock:
+            thread, self._thread = self._thread, None
+            overflow, self._overflow = self._overflow, None
+        if thread is not None:
+            # Queued after everything else, the writer drains the queue first
+            self._queue.put(_STOP)
+            thread.join()
+        if overflow is not None:
+            overflow.shutdown(wait=True)
+
+    def stats(self) -> dict:
+        return {
+            "durability": AUDIT_DURABILITY,
+            "queued": self._queue.qsize(),
+            "written": self.written,
+            "batches": self.batches,
+            "failed": self.failed,
+            "overflow_writes": self.overflow,
+            "unaudited_requests": unaudited_requests,
+        }
+
+
+writer = AuditWriter()
@@ -0,0 +1,78 @@
+import hashlib
+import os
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Set
+
+AUTH_CACHE_SIZE = int(os.getenv("AUTH_CACHE_SIZE", "10000"))
+AUTH_CACHE_TTL = float(os.getenv("AUTH_CACHE_TTL", "300"))  # seconds
+
+
+class TokenCache:
+    # Only touched from the event loop, so no locking is needed
+    def __init__(self, max_size: int = AUTH_CACHE_SIZE, ttl: float = AUTH_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: "OrderedDict[bytes, tuple]" = OrderedDict()
+        self._by_user: Dict[str, Set[bytes]] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _key(token: str) -> bytes:
+        # Keyed on a digest so raw tokens are never kept around in memory
+        return hashlib.sha256(token.encode("utf-8")).digest()
+
+    def _discard(self, key: bytes, username: str):
+        self._entries.pop(key, None)
+        keys = self._by_user.get(username)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_user[username]
+
+    def get(self, token: str) -> Optional[str]:
+        key = self._key(token)
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        username, expires_at = entry
+        if expires_at <= time.time():
+            self._discard(key, username)
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return username
+
+    def put(self, token: str, username: str, exp: float):
+        # Never outlive the token itself
+        expires_at = min(time.time() + self.ttl, exp)
+        key = self._key(token)
+        self._entries[key] = (username, expires_at)
+        self._entries.move_to_end(key)
+        self._by_user.setdefault(username, set()).add(key)
+
+        while len(self._entries) > self.max_size:
+            old_key, (old_user, _) = self._entries.popitem(last=False)
+            self._discard(old_key, old_user)
+            self.evictions += 1
+
+    def invalidate_user(self, username: str):
+        for key in list(self._by_user.get(username, ())):
+            self._discard(key, username)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,6 @@
+# Load/benchmark suite for the FastAPI app.
+#
+#   cd backend
+#   python -m bench run --mode asgi --concurrency 16 --output before.json
+#   python -m bench run --mode live --concurrency 16 --output after.json
+#   python -m bench compare before.json after.json
@@ -0,0 +1,239 @@
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import platform
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+import httpx
+
+from bench import scenarios
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ALL_SCENARIOS = [
+    "register",
+    "token",
+    "upload_small",
+    "upload_medium",
+    "upload_large",
+    "list",
+    "fetch",
+]
+# Metrics compared between runs and whether a higher value is better
+COMPARED = {"throughput": True, "p50_ms": False, "p99_ms": False, "peak_rss_kb": False}
+
+
+def isolated_env(workdir: str, args) -> dict:
+    env = dict(os.environ)
+    env.setdefault("LOG_LEVEL", "WARNING")
+    env["BLOB_DIR"] = os.path.join(workdir, "blobs")
+    env["DATABASE_URL"] = args.database_url or "sqlite:///" + os.path.join(
+        workdir, "bench.db"
+    )
+    return env
+
+
+def self_peak_rss_kb() -> int:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, Linux kilobytes
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+def process_peak_rss_kb(pid: int):
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+async def run_all(client: httpx.AsyncClient, args, peak_rss) -> dict:
+    session = scenarios.Session(client, uuid.uuid4().hex[:8])
+    # Enough users that every concurrent worker has its own token
+    users = max(args.concurrency, 1)
+    factories = {
+        "register": lambda: scenarios.register(session),
+        "token": lambda: scenarios.token(session),
+        "list": lambda: scenarios.list_pdfs(session),
+        "fetch": lambda: scenarios.fetch(session),
+    }
+    for name, size in scenarios.UPLOAD_SIZES.items():
+        factories[name] = lambda name=name, size=size: scenarios.upload(
+            session, name, size, args.seed
+        )
+
+    results = {}
+    for name in ALL_SCENARIOS:
+        if name not in args.scenarios and name not in ("register", "token"):
+            continue
+        requests = args.requests
+        if name == "register":
+            requests = max(requests, users)
+        elif name == "upload_large":
+            requests = max(1, requests // 10)
+
+        result = await scenarios.run_scenario(
+            requests, args.concurrency, factories[name]()
+        )
+        result["peak_rss_kb"] = peak_rss()
+        if name in args.scenarios:
+            results[name] = result
+        print(
+            f"{name:>14}: {result['throughput']:>9.1f} req/s  "
+            f"p50 {result['p50_ms']:>8.2f} ms  p99 {result['p99_ms']:>8.2f} ms  "
+            f"errors {result['errors']}",
+            file=sys.stderr,
+        )
+        if name == "token" and not session.tokens:
+            raise SystemExit("No tokens could be obtained, aborting")
+    return results
+
+
+async def run_asgi(args, workdir: str) -> dict:
+    # The app reads its settings at import, so point it at the scratch dir first
+    os.environ.update(isolated_env(workdir, args))
+    sys.path.insert(0, BACKEND_DIR)
+    from main import app
+
+    transport = httpx.ASGITransport(app=app)
+    async with app.router.lifespan_context(app):
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://bench", timeout=args.timeout
+        ) as client:
+            return await run_all(client, args, self_peak_rss_kb)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def wait_until_up(url: str, deadline: float):
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            try:
+                await client.get(url + "/metrics")
+                return
+            except httpx.TransportError:
+                await asyncio.sleep(0.1)
+    raise SystemExit(f"Server at {url} did not come up")
+
+
+async def run_live(args, workdir: str) -> dict:
+    port = args.port or free_port()
+    url = f"http://127.0.0.1:{port}"
+    command = [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port)]
+    command += ["--workers", str(args.workers), "--log-level", "warning"]
+    server = subprocess.Popen(
+        command,
+        cwd=BACKEND_DIR,
+        env=isolated_env(workdir, args),
+    )
+    try:
+        await wait_until_up(url, time.monotonic() + 30)
+        limits = httpx.Limits(max_connections=args.concurrency)
+        async with httpx.AsyncClient(
+            base_url=url, timeout=args.timeout, limits=limits
+        ) as client:
+            return await run_all(
+                client, args, lambda: process_peak_rss_kb(server.pid)
+            )
+    finally:
+        server.terminate()
+        server.wait(timeout=10)
+
+
+def run(args):
+    with tempfile.TemporaryDirectory(prefix="rolsa-bench-") as workdir:
+        runner = run_live if args.mode == "live" else run_asgi
+        results = asyncio.run(runner(args, workdir))
+
+    report = {
+        "meta": {
+            "mode": args.mode,
+            "concurrency": args.concurrency,
+            "requests": args.requests,
+            "seed": args.seed,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        },
+        "scenarios": results,
+    }
+    with open(args.output, "w") as output:
+        json.dump(report, output, indent=2)
+    print(f"Results written to {args.output}", file=sys.stderr)
+
+
+def compare(args) -> int:
+    with open(args.baseline) as f:
+        baseline = json.load(f)["scenarios"]
+    with open(args.candidate) as f:
+        candidate = json.load(f)["scenarios"]
+
+    regressions = 0
+    for name in ALL_SCENARIOS:
+        if name not in baseline or name not in candidate:
+            continue
+        for metric, higher_is_better in COMPARED.items():
+            before = baseline[name].get(metric)
+            after = candidate[name].get(metric)
+            if not before or after is None:
+                continue
+            change = (after - before) / before
+            worse = -change if higher_is_better else change
+            flag = "REGRESSION" if worse > args.threshold else ""
+            regressions += bool(flag)
+            print(
+                f"{name:>14} {metric:>12}: {before:>12.2f} -> {after:>12.2f} "
+                f"({change:+.1%}) {flag}"
+            )
+    print(f"{regressions} regression(s) above {args.threshold:.0%}")
+    return 1 if regressions else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m bench")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="run the benchmark scenarios")
+    run_parser.add_argument("--mode", choices=["asgi", "live"], default="asgi")
+    run_parser.add_argument("--concurrency", type=int, default=8)
+    run_parser.add_argument("--requests", type=int, default=200)
+    run_parser.add_argument(
+        "--scenarios",
+        type=lambda value: value.split(","),
+        default=ALL_SCENARIOS,
+        help="comma separated subset of " + ",".join(ALL_SCENARIOS),
+    )
+    run_parser.add_argument("--seed", type=int, default=1)
+    run_parser.add_argument("--timeout", type=float, default=60.0)
+    run_parser.add_argument("--port", type=int, default=0)
+    run_parser.add_argument("--workers", type=int, default=1)
+    run_parser.add_argument("--database-url", default=None)
+    run_parser.add_argument("--output", default="bench_results.json")
+
+    compare_parser = commands.add_parser("compare", help="diff two result files")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("candidate")
+    compare_parser.add_argument("--threshold", type=float, default=0.10)
+
+    args = parser.parse_args()
+    if args.command == "compare":
+        sys.exit(compare(args))
+    run(args)
+
+
+if __name__ == "__main__":
+    main()
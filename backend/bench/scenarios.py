@@ -0,0 +1,147 @@
+import asyncio
+import functools
+import random
+import time
+from typing import Awaitable, Callable, Dict, List
+
+import httpx
+
+# Payload sizes for the upload scenarios
+UPLOAD_SIZES = {
+    "upload_small": 16 * 1024,
+    "upload_medium": 1024 * 1024,
+    "upload_large": 16 * 1024 * 1024,
+}
+
+
+@functools.lru_cache(maxsize=None)
+def make_pdf(size: int, seed: int) -> bytes:
+    header = b"%PDF-1.4\n"
+    body = random.Random(seed).randbytes(max(size - len(header) - 6, 0))
+    return header + body + b"\n%%EOF"
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(q * (len(ordered) - 1))))
+    return ordered[index]
+
+
+class Session:
+    """Users, tokens and uploaded ids shared between scenarios of one run."""
+
+    def __init__(self, client: httpx.AsyncClient, run_id: str):
+        self.client = client
+        self.run_id = run_id
+        self.users: List[str] = []
+        self.tokens: List[str] = []
+        # Uploaded ids per token slot, so fetches use the owner's token
+        self.pdf_ids: Dict[int, List[str]] = {}
+
+    def slot(self, i: int) -> int:
+        return i % len(self.tokens)
+
+    def auth(self, i: int) -> dict:
+        return {"Authorization": f"Bearer {self.tokens[self.slot(i)]}"}
+
+
+async def run_scenario(
+    requests: int, concurrency: int, call: Callable[[int], Awaitable[int]]
+) -> dict:
+    """Run call(i) for i in range(requests) with at most concurrency in flight."""
+    latencies: List[float] = []
+    errors = 0
+    next_index = iter(range(requests))
+
+    async def worker():
+        nonlocal errors
+        for i in next_index:
+            start = time.perf_counter()
+            try:
+                status = await call(i)
+            except httpx.HTTPError:
+                status = 0
+            latencies.append(time.perf_counter() - start)
+            if not 200 <= status < 300:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    mean = sum(latencies) / len(latencies) if latencies else 0.0
+
+    return {
+        "requests": requests,
+        "errors": errors,
+        "seconds": round(elapsed, 4),
+        "throughput": round(requests / elapsed, 2) if elapsed else 0.0,
+        "mean_ms": round(1000 * mean, 3),
+        "p50_ms": round(1000 * percentile(latencies, 0.50), 3),
+        "p99_ms": round(1000 * percentile(latencies, 0.99), 3),
+    }
+
+
+def register(session: Session):
+    async def call(i: int) -> int:
+        username = f"bench_{session.run_id}_{i}"
+        response = await session.client.post(
+            "/register", json={"username": username, "password": "bench-password"}
+        )
+        if response.status_code == 200:
+            session.users.append(username)
+        return response.status_code
+
+    return call
+
+
+def token(session: Session):
+    async def call(i: int) -> int:
+        username = session.users[i % len(session.users)]
+        response = await session.client.post(
+            "/token", data={"username": username, "password": "bench-password"}
+        )
+        if response.status_code == 200 and len(session.tokens) < len(session.users):
+            session.tokens.append(response.json()["access_token"])
+        return response.status_code
+
+    return call
+
+
+def upload(session: Session, name: str, size: int, seed: int):
+    async def call(i: int) -> int:
+        # Unique trailer per request so the blob store's dedup doesn't kick in
+        content = make_pdf(size, seed) + f"\n% {i}".encode()
+        response = await session.client.post(
+            "/upload-pdf",
+            files={"file": (f"{name}_{i}.pdf", content, "application/pdf")},
+            headers=session.auth(i),
+        )
+        if response.status_code == 200:
+            pdf_id = response.json()["pdf_id"]
+            session.pdf_ids.setdefault(session.slot(i), []).append(pdf_id)
+        return response.status_code
+
+    return call
+
+
+def list_pdfs(session: Session):
+    async def call(i: int) -> int:
+        response = await session.client.get("/pdfs", headers=session.auth(i))
+        return response.status_code
+
+    return call
+
+
+def fetch(session: Session):
+    async def call(i: int) -> int:
+        ids = session.pdf_ids.get(session.slot(i))
+        if not ids:
+            return 0
+        response = await session.client.get(
+            f"/pdf/{ids[i % len(ids)]}/raw", headers=session.auth(i)
+        )
+        return response.status_code
+
+    return call
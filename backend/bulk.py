@@ -0,0 +1,243 @@
+import argparse
+import csv
+import datetime
+import decimal
+import enum
+import io
+import json
+import os
+import sys
+from typing import Iterable, Iterator, List, Optional
+
+from pydantic import ValidationError
+from sqlalchemy import select
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session
+
+import audit
+import models
+import rollups
+import schemas
+from database import SessionLocal
+
+BULK_BATCH_SIZE = int(os.getenv("BULK_BATCH_SIZE", "5000"))
+BULK_EXPORT_CHUNK = int(os.getenv("BULK_EXPORT_CHUNK", "5000"))
+MAX_REPORTED_ERRORS = 100
+FORMATS = ("csv", "ndjson")
+
+# Import schema, model and exported columns for each kind of data
+KINDS = {
+    "properties": (
+        schemas.PropertyCreate,
+        models.Property,
+        [
+            "property_id",
+            "user_id",
+            "address_line1",
+            "address_line2",
+            "city",
+            "postcode",
+            "property_type",
+            "roof_size",
+            "roof_profile",
+            "created_at",
+        ],
+    ),
+    "energy_calculations": (
+        schemas.EnergyCalculationCreate,
+        models.EnergyCalculation,
+        ["calculation_id", "user_id", "property_id", "energy_consumption", "date"],
+    ),
+}
+
+
+def parse_records(lines: Iterable[str], fmt: str) -> Iterator[tuple]:
+    """(line number, dict) pairs, read one line at a time."""
+    if fmt == "csv":
+        reader = csv.DictReader(lines)
+        for record in reader:
+            # Empty cells mean missing values, not empty strings
+            yield reader.line_num, {k: v for k, v in record.items() if v != ""}
+        return
+    for number, line in enumerate(lines, 1):
+        if line.strip():
+            try:
+                yield number, json.loads(line)
+            except ValueError as e:
+                yield number, e
+
+
+def db_value(value):
+    return value.value if isinstance(value, enum.Enum) else value
+
+
+class Importer:
+    def __init__(self, db: Session, kind: str, batch_size: int = BULK_BATCH_SIZE):
+        self.db = db
+        self.schema, self.model, _ = KINDS[kind]
+        self.batch_size = batch_size
+        self.inserted = 0
+        self.rejected = 0
+        self.errors: List[dict] = []
+        self._batch: List[dict] = []
+        self._first_line = 0
+
+    def _reject(self, line: int, error: str, count: int = 1):
+        self.rejected += count
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({"line": line, "error": error})
+
+    def add(self, line: int, record):
+        if isinstance(record, Exception) or not isinstance(record, dict):
+            self._reject(line, f"Invalid JSON: {record}")
+            return
+        try:
+            row = self.schema(**record).model_dump()
+        except ValidationError as e:
+            self._reject(line, "; ".join(err["msg"] for err in e.errors()))
+            return
+        if not self._batch:
+            self._first_line = line
+        self._batch.append({k: db_value(v) for k, v in row.items()})
+        if len(self._batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        rows, self._batch = self._batch, []
+        if not rows:
+            return
+        deltas: rollups.Deltas = {}
+        if self.model is models.EnergyCalculation:
+            now = datetime.datetime.utcnow()
+            for row in rows:
+                row["date"] = row["date"] or now
+                day = row["date"].date()
+                energy = row["energy_consumption"]
+                for scope in ("property", "user"):
+                    scope_id = row[f"{scope}_id"]
+                    rollups.add_delta(deltas, scope, scope_id, day, energy, 1)
+        try:
+            # One executemany per batch, committed so a bad batch only loses itself
+            # Core inserts skip the flush hooks, auditing and rollups are here
+            audit.insert_rows(self.db, self.model, rows)
+            rollups.apply_deltas(self.db.connection(), deltas)
+            self.db.commit()
+            self.inserted += len(rows)
+        except SQLAlchemyError as e:
+            self.db.rollback()
+            error = f"Batch of {len(rows)} rows rejected: {e.__class__.__name__}"
+            self._reject(self._first_line, error, len(rows))
+
+    def summary(self) -> dict:
+        return {
+            "inserted": self.inserted,
+            "rejected": self.rejected,
+            "errors": self.errors,
+        }
+
+
+def import_records(
+    db: Session,
+    kind: str,
+    lines: Iterable[str],
+    fmt: str,
+    batch_size: int = BULK_BATCH_SIZE,
+) -> dict:
+    importer = Importer(db, kind, batch_size)
+    for line, record in parse_records(lines, fmt):
+        importer.add(line, record)
+    importer.flush()
+    return importer.summary()
+
+
+def export_value(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    return value
+
+
+def export_records(
+    db: Session,
+    kind: str,
+    fmt: str,
+    user_id: Optional[int] = None,
+    chunk_size: int = BULK_EXPORT_CHUNK,
+) -> Iterator[bytes]:
+    """Encoded chunks of the export, one per chunk_size rows."""
+    _, model, columns = KINDS[kind]
+    query = select(*(getattr(model, column) for column in columns))
+    if user_id is not None:
+        query = query.where(model.user_id == user_id)
+    # yield_per streams from a server side cursor where the driver has one
+    result = db.execute(
+        query.order_by(getattr(model, columns[0])).execution_options(
+            yield_per=chunk_size
+        )
+    )
+
+    if fmt == "csv":
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(columns)
+        for rows in result.partitions():
+            for row in rows:
+                writer.writerow(["" if v is None else export_value(v) for v in row])
+            yield buffer.getvalue().encode("utf-8")
+            buffer.seek(0)
+            buffer.truncate()
+        if buffer.tell():
+            yield buffer.getvalue().encode("utf-8")
+        return
+
+    for rows in result.partitions():
+        yield "".join(
+            json.dumps(dict(zip(columns, map(export_value, row)))) + "\n"
+            for row in rows
+        ).encode("utf-8")
+
+
+def stream_export(kind: str, fmt: str, user_id: Optional[int] = None):
+    # The session lives as long as the response is being streamed
+    with SessionLocal() as session:
+        yield from export_records(session, kind, fmt, user_id)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m bulk")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    import_parser = commands.add_parser("import", help="load a CSV or NDJSON file")
+    import_parser.add_argument("kind", choices=list(KINDS))
+    import_parser.add_argument("path", help="file to read, - for stdin")
+    import_parser.add_argument("--format", choices=FORMATS, default=None)
+    import_parser.add_argument("--batch-size", type=int, default=BULK_BATCH_SIZE)
+
+    export_parser = commands.add_parser("export", help="write a CSV or NDJSON file")
+    export_parser.add_argument("kind", choices=list(KINDS))
+    export_parser.add_argument("--format", choices=FORMATS, default="csv")
+    export_parser.add_argument("--user-id", type=int, default=None)
+    export_parser.add_argument("--output", default="-")
+
+    args = parser.parse_args()
+    if args.command == "import":
+        fmt = args.format or ("ndjson" if args.path.endswith(".ndjson") else "csv")
+        source = (
+            sys.stdin
+            if args.path == "-"
+            else open(args.path, encoding="utf-8", newline="")
+        )
+        with SessionLocal() as session, source:
+            summary = import_records(session, args.kind, source, fmt, args.batch_size)
+        print(json.dumps(summary, indent=2))
+        return
+
+    output = sys.stdout.buffer if args.output == "-" else open(args.output, "wb")
+    with SessionLocal() as session, output:
+        for chunk in export_records(session, args.kind, args.format, args.user_id):
+            output.write(chunk)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,283 @@
+import datetime
+import json
+import os
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from sqlalchemy import delete, select
+from sqlalchemy.orm import Session
+
+import audit
+import models
+import rollups
+
+# Annual grid consumption is a per property type baseline less what the roof
+# can generate: roof_size (m2) * SOLAR_YIELD_PER_M2 (kWh) * the profile factor.
+# Carbon is that consumption times the grid emission factor (kg CO2e / kWh).
+# A JSON file at CALCULATION_FACTORS can override any of the tables.
+# A run replaces the calculations its properties already have for the month it
+# runs in, so running it again doesn't count them twice.
+GRID_EMISSION_FACTOR = float(os.getenv("GRID_EMISSION_FACTOR", "0.207"))
+SOLAR_YIELD_PER_M2 = float(os.getenv("SOLAR_YIELD_PER_M2", "150"))
+CALCULATION_CHUNK_SIZE = int(os.getenv("CALCULATION_CHUNK_SIZE", "50000"))
+DELETE_BATCH = 500  # ids per DELETE, well under every driver's parameter limit
+
+TYPE_BASELINE_KWH = {
+    "Detached": 4300.0,
+    "Semi-detached": 3400.0,
+    "Terraced": 2900.0,
+    "Bungalow": 3100.0,
+    "Flat": 2000.0,
+    "Commercial": 12000.0,
+}
+DEFAULT_BASELINE_KWH = 3100.0
+ROOF_PROFILE_FACTOR = {
+    "Sloped": 1.0,
+    "Steep-Sloped": 0.9,
+    "Flat": 0.8,
+    "Dome": 0.6,
+    "Other": 0.7,
+}
+
+
+def load_factors(path: Optional[str] = os.getenv("CALCULATION_FACTORS")) -> dict:
+    factors = {
+        "emission_factor": GRID_EMISSION_FACTOR,
+        "solar_yield_per_m2": SOLAR_YIELD_PER_M2,
+        "type_baseline_kwh": dict(TYPE_BASELINE_KWH),
+        "default_baseline_kwh": DEFAULT_BASELINE_KWH,
+        "roof_profile_factor": dict(ROOF_PROFILE_FACTOR),
+    }
+    if path:
+        with open(path) as f:
+            factors.update(json.load(f))
+    return factors
+
+
+def lookup(values: np.ndarray, table: Dict[str, float], default: float) -> np.ndarray:
+    # Categorical columns are mapped through their distinct values, so the
+    # Python dict is consulted once per category rather than once per row
+    categories, codes = np.unique(values, return_inverse=True)
+    coefficients = np.array(
+        [table.get(category, default) for category in categories.tolist()],
+        dtype=np.float64,
+    )
+    return coefficients[codes]
+
+
+def compute(
+    property_types: np.ndarray,
+    roof_sizes: np.ndarray,
+    roof_profiles: np.ndarray,
+    factors: dict,
+):
+    """Consumption (kWh) and carbon (kg) arrays for a chunk of properties."""
+    baseline = lookup(
+        property_types, factors["type_baseline_kwh"], factors["default_baseline_kwh"]
+    )
+    profile = lookup(roof_profiles, factors["roof_profile_factor"], 0.0)
+    generation = roof_sizes * factors["solar_yield_per_m2"] * profile
+    consumption = np.round(np.maximum(baseline - generation, 0.0), 2)
+    carbon = np.round(consumption * factors["emission_factor"], 2)
+    return consumption, carbon
+
+
+def property_filter(
+    property_ids: Optional[List[int]] = None, user_id: Optional[int] = None
+) -> list:
+    conditions = [models.Property.user_id.is_not(None)]
+    if property_ids is not None:
+        conditions.append(models.Property.property_id.in_(property_ids))
+    if user_id is not None:
+        conditions.append(models.Property.user_id == user_id)
+    return conditions
+
+
+def property_chunks(
+    db: Session,
+    property_ids: Optional[List[int]] = None,
+    user_id: Optional[int] = None,
+    chunk_size: int = CALCULATION_CHUNK_SIZE,
+) -> Iterable[list]:
+    query = select(
+        models.Property.property_id,
+        models.Property.user_id,
+        models.Property.property_type,
+        models.Property.roof_size,
+        models.Property.roof_profile,
+    ).where(*property_filter(property_ids, user_id))
+    # Keyset pages rather than a server side cursor, the inserts run on the
+    # same connection in between and not every driver allows that mid-cursor
+    last_id = 0
+    while True:
+        rows = db.execute(
+            query.where(models.Property.property_id > last_id)
+            .order_by(models.Property.property_id)
+            .limit(chunk_size)
+        ).all()
+        if not rows:
+            return
+        yield rows
+        last_id = rows[-1][0]
+
+
+def rollup_deltas(
+    property_ids, user_ids, consumption: np.ndarray, carbon: np.ndarray, day
+) -> rollups.Deltas:
+    deltas: rollups.Deltas = {}
+    for args in zip(property_ids, consumption.tolist(), carbon.tolist()):
+        prop, energy, released = args
+        rollups.add_delta(deltas, "property", prop, day, energy, 1, released, 1)
+    # Per user totals are summed with bincount instead of row by row
+    users, inverse = np.unique(np.asarray(user_ids), return_inverse=True)
+    counts = np.bincount(inverse)
+    energy_totals = np.bincount(inverse, weights=consumption)
+    carbon_totals = np.bincount(inverse, weights=carbon)
+    for user, count, energy, released in zip(
+        users.tolist(), counts.tolist(), energy_totals.tolist(), carbon_totals.tolist()
+    ):
+        rollups.add_delta(deltas, "user", user, day, energy, count, released, count)
+    return deltas
+
+
+def month_bounds(
+    when: datetime.datetime,
+) -> Tuple[datetime.datetime, datetime.datetime]:
+    start = when.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    return start, (start + datetime.timedelta(days=32)).replace(day=1)
+
+
+def replace_previous(
+    db: Session, model, value_column, selected, month, deltas: rollups.Deltas
+) -> int:
+    """Delete the selected properties' rows of model dated in month.
+
+    Their values go into deltas negated, so the rollups drop them too.
+    """
+    key = model.calculation_id
+    since, until = month
+    rows = db.execute(
+        select(key, model.property_id, model.user_id, value_column, model.date).where(
+            model.property_id.in_(selected), model.date >= since, model.date < until
+        )
+    ).all()
+    for _, prop, user, amount, date in rows:
+        rollups.add_values(deltas, model, prop, user, amount, date, -1)
+    ids = [row[0] for row in rows]
+    for i in range(0, len(ids), DELETE_BATCH):
+        db.execute(delete(model).where(key.in_(ids[i : i + DELETE_BATCH])))
+    audit.record(
+        db,
+        model,
+        "delete",
+        (
+            (
+                row[0],
+                {
+                    "property_id": row[1],
+                    "user_id": row[2],
+                    value_column.key: audit.json_value(row[3]),
+                    "date": audit.json_value(row[4]),
+                },
+                None,
+            )
+            for row in rows
+        ),
+    )
+    return len(rows)
+
+
+def run_batch(
+    db: Session,
+    factors: Optional[dict] = None,
+    property_ids: Optional[List[int]] = None,
+    user_id: Optional[int] = None,
+    chunk_size: int = CALCULATION_CHUNK_SIZE,
+) -> dict:
+    """Recompute both tables for the selected properties in one transaction."""
+    factors = factors or load_factors()
+    run_at = datetime.datetime.utcnow()
+    month = month_bounds(run_at)
+    start = time.perf_counter()
+    processed = 0
+    replaced = 0
+    total_consumption = 0.0
+    total_carbon = 0.0
+
+    for rows in property_chunks(db, property_ids, user_id, chunk_size):
+        property_id, owner, property_type, roof_size, roof_profile = zip(*rows)
+        consumption, carbon = compute(
+            np.array([value or "" for value in property_type], dtype=object),
+            np.array([value or 0 for value in roof_size], dtype=np.float64),
+            np.array([value or "" for value in roof_profile], dtype=object),
+            factors,
+        )
+        consumption_values = consumption.tolist()
+        carbon_values = carbon.tolist()
+        deltas = rollup_deltas(property_id, owner, consumption, carbon, run_at.date())
+        # The chunk's properties by range, an IN list of a whole chunk could
+        # pass the driver's parameter limit
+        selected = select(models.Property.property_id).where(
+            *property_filter(property_ids, user_id),
+            models.Property.property_id.between(property_id[0], property_id[-1]),
+        )
+        replaced += replace_previous(
+            db,
+            models.EnergyCalculation,
+            models.EnergyCalculation.energy_consumption,
+            selected,
+            month,
+            deltas,
+        )
+        replace_previous(
+            db,
+            models.CarbonFootprint,
+            models.CarbonFootprint.carbon_released,
+            selected,
+            month,
+            deltas,
+        )
+        # Core inserts go out as executemany, no ORM objects per row. They
+        # skip the flush hooks, so auditing and the rollups are done here.
+        audit.insert_rows(
+            db,
+            models.EnergyCalculation,
+            [
+                {
+                    "user_id": user,
+                    "property_id": prop,
+                    "energy_consumption": value,
+                    "date": run_at,
+                }
+                for user, prop, value in zip(owner, property_id, consumption_values)
+            ],
+        )
+        audit.insert_rows(
+            db,
+            models.CarbonFootprint,
+            [
+                {
+                    "user_id": user,
+                    "property_id": prop,
+                    "carbon_released": value,
+                    "date": run_at,
+                }
+                for user, prop, value in zip(owner, property_id, carbon_values)
+            ],
+        )
+        rollups.apply_deltas(db.connection(), deltas)
+        processed += len(rows)
+        total_consumption += float(consumption.sum())
+        total_carbon += float(carbon.sum())
+
+    db.commit()
+    return {
+        "properties": processed,
+        "replaced": replaced,
+        "run_at": run_at.isoformat(),
+        "seconds": round(time.perf_counter() - start, 3),
+        "emission_factor": factors["emission_factor"],
+        "total_energy_consumption": round(total_consumption, 2),
+        "total_carbon_released": round(total_carbon, 2),
+    }
@@ -0,0 +1,64 @@
+import lzma
+import os
+import zlib
+from typing import Optional
+
+# Codec used for new blobs: "none", "zlib" or "lzma"
+STORAGE_CODEC = os.getenv("STORAGE_CODEC", "zlib")
+STORAGE_CODEC_LEVEL = int(os.getenv("STORAGE_CODEC_LEVEL", "6"))
+# Content is stored raw unless a sample shrinks by at least this fraction
+STORAGE_MIN_SAVING = float(os.getenv("STORAGE_MIN_SAVING", "0.1"))
+SAMPLE_SIZE = 256 * 1024
+
+# Compressed blobs start with this header. Whether a blob is compressed is
+# never guessed from its first bytes, an upload can start with anything: the
+# file store puts the codec in the file name and the segment store gives raw
+# records a header too.
+MAGIC = b"RBLB"
+HEADER_SIZE = len(MAGIC) + 1
+CODEC_IDS = {"none": 0, "zlib": 1, "lzma": 2}
+CODEC_NAMES = {value: key for key, value in CODEC_IDS.items()}
+
+
+def header(codec: str) -> bytes:
+    return MAGIC + bytes([CODEC_IDS[codec]])
+
+
+def codec_from_header(data: bytes) -> str:
+    """Codec named by a header, for data that's known to start with one."""
+    if len(data) < HEADER_SIZE or not data.startswith(MAGIC):
+        raise ValueError("Missing blob header")
+    codec = CODEC_NAMES.get(data[len(MAGIC)])
+    if codec is None:
+        raise ValueError(f"Unknown codec id {data[len(MAGIC)]}")
+    return codec
+
+
+def compressor(codec: str, level: int):
+    if codec == "zlib":
+        return zlib.compressobj(level)
+    if codec == "lzma":
+        return lzma.LZMACompressor(preset=min(level, 9))
+    raise ValueError(f"Unknown codec {codec}")
+
+
+def decompressor(codec: str):
+    if codec == "zlib":
+        return zlib.decompressobj()
+    if codec == "lzma":
+        return lzma.LZMADecompressor()
+    raise ValueError(f"Unknown codec {codec}")
+
+
+def choose_codec(
+    sample: bytes, codec: str = STORAGE_CODEC, level: int = STORAGE_CODEC_LEVEL
+) -> Optional[str]:
+    """Codec to store this content with, None when it isn't worth compressing."""
+    if codec == "none" or not sample:
+        return None
+    # Already compressed streams (images, Flate encoded pages) barely shrink
+    engine = compressor(codec, level)
+    compressed = len(engine.compress(sample)) + len(engine.flush())
+    if compressed > len(sample) * (1 - STORAGE_MIN_SAVING):
+        return None
+    return codec
@@ -1,17 +1,105 @@
-from sqlalchemy import create_engine
+import os
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 
-URL_DATABASE = ""
+# Local runs use a SQLite file next to this module, set DATABASE_URL for MySQL etc.
+URL_DATABASE = os.getenv(
+    "DATABASE_URL",
+    "sqlite:///" + os.path.join(os.path.dirname(os.path.abspath(__file__)), "rolsa.db"),
+)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", "30"))
+
+# Async driver used by the request handlers for each sync URL scheme
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "postgresql": "postgresql+asyncpg",
+    "mysql": "mysql+aiomysql",
+}
+
+
+def to_async_url(url: str) -> str:
+    scheme, sep, rest = url.partition("://")
+    dialect, _, driver = scheme.partition("+")
+    if driver in ("aiosqlite", "asyncpg", "aiomysql", "asyncmy"):
+        return url
+    return ASYNC_DRIVERS.get(dialect, scheme) + sep + rest
+
+
+ASYNC_URL_DATABASE = os.getenv("ASYNC_DATABASE_URL", to_async_url(URL_DATABASE))
+
+is_sqlite = URL_DATABASE.startswith("sqlite")
+
+engine_options = {"pool_pre_ping": True}
+if is_sqlite:
+    engine_options["connect_args"] = {"check_same_thread": False}
+if ":memory:" not in URL_DATABASE and URL_DATABASE.rstrip("/") != "sqlite:":
+    # In memory SQLite uses a single connection pool without overflow
+    engine_options.update(
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_timeout=DB_POOL_TIMEOUT,
+    )
 
 engine = create_engine(
-    URL_DATABASE, connect_args={"check_same_thread": False}
+    URL_DATABASE, **engine_options
 )  # Creates a SQLAlchemy engine that will interact with the database
 
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL lets readers carry on while a request is writing
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.close()
+
+
+# Request handlers go through this one so DB waits don't block the event loop
+async_engine = create_async_engine(ASYNC_URL_DATABASE, **engine_options)
+
+if is_sqlite:
+    event.listen(engine, "connect", set_sqlite_pragmas)
+    event.listen(async_engine.sync_engine, "connect", set_sqlite_pragmas)
+
 SessionLocal = sessionmaker(
     autocommit=False, autoflush=False, bind=engine
 )  # Creates a configured "Session" that is bound to the engine
 
+AsyncSessionLocal = async_sessionmaker(
+    async_engine, expire_on_commit=False
+)  # Rows stay readable after commit, async sessions can't lazy load
+
 Base = (
     declarative_base()
 )  # This defines the base class which the mapped classes will inherit from
+
+
+def get_db():
+    db = SessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
+def pool_status(bind=None) -> dict:
+    # Snapshot of the connection pool, handy for spotting pool exhaustion
+    pool = (bind or async_engine).pool
+    status = {"pool": type(pool).__name__}
+    for name in ("size", "checkedin", "checkedout", "overflow"):
+        method = getattr(pool, name, None)
+        if method is not None:
+            status[name] = method()
+    return status
@@ -0,0 +1,211 @@
+import asyncio
+import difflib
+import json
+import os
+import threading
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+
+from logger import get_logger
+
+log = get_logger("legal")
+
+# A revision is stored as a line delta against the newest full snapshot of the
+# same title and type, so reading any version takes one snapshot and one delta
+# whatever the history length. A fresh snapshot is written every
+# LEGAL_SNAPSHOT_EVERY versions, or sooner once the delta stops being much
+# smaller than the text itself.
+LEGAL_SNAPSHOT_EVERY = int(os.getenv("LEGAL_SNAPSHOT_EVERY", "10"))
+LEGAL_SNAPSHOT_RATIO = float(os.getenv("LEGAL_SNAPSHOT_RATIO", "0.5"))
+LEGAL_CACHE_BYTES = int(os.getenv("LEGAL_CACHE_BYTES", str(32 * 1024 * 1024)))
+LEGAL_SWEEP_INTERVAL = float(os.getenv("LEGAL_SWEEP_INTERVAL", "3600"))
+LEGAL_SWEEP_BATCH = int(os.getenv("LEGAL_SWEEP_BATCH", "500"))
+
+Key = Tuple[str, str]  # title, document_type
+# Archives one batch of expired rows, returns (document_id, title, type) for each
+Sweep = Callable[[int], Awaitable[List[Tuple[int, str, str]]]]
+# (title, type, latest active document_id) rows for the whole index
+Refresh = Callable[[], Awaitable[List[Tuple[str, str, int]]]]
+Fetch = Callable[[int], Awaitable[str]]  # a snapshot's content by id
+
+
+def make_delta(base: str, text: str) -> str:
+    """JSON list of [start, end] base line ranges to copy and strings to insert."""
+    base_lines = base.splitlines(keepends=True)
+    lines = text.splitlines(keepends=True)
+    ops: list = []
+    matcher = difflib.SequenceMatcher(None, base_lines, lines)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            ops.append([i1, i2])
+        elif j2 > j1:
+            ops.append("".join(lines[j1:j2]))
+    return json.dumps(ops, separators=(",", ":"))
+
+
+def apply_delta(base: str, delta: str) -> str:
+    base_lines = base.splitlines(keepends=True)
+    return "".join(
+        op if isinstance(op, str) else "".join(base_lines[op[0] : op[1]])
+        for op in json.loads(delta)
+    )
+
+
+class VersionCache:
+    """LRU of materialised document texts, bounded by their total length."""
+
+    def __init__(self, max_bytes: int = LEGAL_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[int, str]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, document_id: int) -> Optional[str]:
+        with self._lock:
+            text = self._entries.get(document_id)
+            if text is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(document_id)
+            self.hits += 1
+            return text
+
+    def put(self, document_id: int, text: str):
+        if len(text) > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(document_id, None)
+            if previous is not None:
+                self.size -= len(previous)
+            self._entries[document_id] = text
+            self.size += len(text)
+            while self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.size,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+class LegalVersions:
+    def __init__(
+        self,
+        snapshot_every: int = LEGAL_SNAPSHOT_EVERY,
+        cache_bytes: int = LEGAL_CACHE_BYTES,
+    ):
+        self.snapshot_every = snapshot_every
+        self.cache = VersionCache(cache_bytes)
+        self._latest: Dict[Key, int] = {}
+        self._lock = threading.Lock()
+        self._task = None
+        self.snapshots = 0
+        self.deltas = 0
+        self.archived = 0
+
+    def load(self, rows: Iterable[Tuple[str, str, int]]):
+        latest = {(title, document_type): i for title, document_type, i in rows}
+        with self._lock:
+            self._latest = latest
+
+    def latest(self, title: str, document_type: str) -> Optional[int]:
+        return self._latest.get((title, document_type))
+
+    def set_latest(self, title: str, document_type: str, document_id: int):
+        with self._lock:
+            key = (title, document_type)
+            if document_id > self._latest.get(key, 0):
+                self._latest[key] = document_id
+
+    def replace_latest(self, keys: Iterable[Key], latest: Dict[Key, int]):
+        # Keys with no active version left drop out of the index
+        with self._lock:
+            for key in keys:
+                if key in latest:
+                    self._latest[key] = latest[key]
+                else:
+                    self._latest.pop(key, None)
+
+    def encode(
+        self, base: Optional[str], deltas_since: int, text: str
+    ) -> Optional[str]:
+        """Delta of text against the base snapshot, None to store a snapshot."""
+        if base is None or deltas_since >= self.snapshot_every - 1:
+            self.snapshots += 1
+            return None
+        delta = make_delta(base, text)
+        if len(delta) > LEGAL_SNAPSHOT_RATIO * len(text):
+            self.snapshots += 1
+            return None
+        self.deltas += 1
+        return delta
+
+    async def snapshot(self, document_id: int, fetch: Fetch) -> str:
+        # Cached too, every delta since that snapshot is applied to it
+        text = self.cache.get(document_id)
+        if text is None:
+            text = await fetch(document_id)
+            self.cache.put(document_id, text)
+        return text
+
+    async def content(self, document, fetch: Fetch) -> str:
+        """Full text of any version."""
+        if document.content is not None:
+            return document.content
+        text = self.cache.get(document.document_id)
+        if text is not None:
+            return text
+        base = await self.snapshot(document.base_document_id, fetch)
+        text = apply_delta(base, document.delta)
+        self.cache.put(document.document_id, text)
+        return text
+
+    async def sweep(self, archive: Sweep) -> int:
+        """Archive expired versions in batches, returns how many were archived."""
+        archived = 0
+        while True:
+            # Short transactions, so requests aren't held up behind the sweep
+            rows = await archive(LEGAL_SWEEP_BATCH)
+            archived += len(rows)
+            if len(rows) < LEGAL_SWEEP_BATCH:
+                break
+        if archived:
+            log.info("Archived %d expired legal documents", archived)
+        self.archived += archived
+        return archived
+
+    async def _maintain(self, archive: Sweep, refresh: Refresh):
+        while True:
+            try:
+                await self.sweep(archive)
+                # Also picks up versions added by other worker processes
+                self.load(await refresh())
+            except Exception:
+                log.exception("Archiving expired legal documents failed")
+            await asyncio.sleep(LEGAL_SWEEP_INTERVAL)
+
+    def start(self, archive: Sweep, refresh: Refresh):
+        self._task = asyncio.get_running_loop().create_task(
+            self._maintain(archive, refresh)
+        )
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def stats(self) -> dict:
+        return {
+            "titles": len(self._latest),
+            "snapshots_written": self.snapshots,
+            "deltas_written": self.deltas,
+            "archived": self.archived,
+            "cache": self.cache.stats(),
+        }
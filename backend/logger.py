@@ -0,0 +1,149 @@
+import atexit
+import contextvars
+import datetime
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+from typing import Dict, Optional
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")  # "json" or "text"
+# Set to 0 in production, per-request debug lines are then never even built
+REQUEST_DEBUG_LOGGING = os.getenv("REQUEST_DEBUG_LOGGING", "1") == "1"
+# Fraction of requests whose debug/info lines are kept, e.g. "/pdfs=0.1,/pdf/=0.01"
+LOG_SAMPLE_RATES = os.getenv("LOG_SAMPLE_RATES", "")
+
+# Set per request by RequestLogContext, read when a record is logged
+current_path: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar(
+    "current_path", default=None
+)
+request_sampled: contextvars.ContextVar[bool] = contextvars.ContextVar(
+    "request_sampled", default=True
+)
+
+_handler: Optional[logging.Handler] = None
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def parse_sample_rates(spec: str) -> Dict[str, float]:
+    rates = {}
+    for item in spec.split(","):
+        prefix, sep, rate = item.strip().partition("=")
+        if sep:
+            rates[prefix.strip()] = float(rate)
+    return rates
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    # The stock handler formats the message before queueing, we leave that to
+    # the listener thread so the request only pays for an enqueue
+    def prepare(self, record):
+        return record
+
+
+class SampledRequestFilter(logging.Filter):
+    def filter(self, record):
+        record.path = current_path.get()
+        return record.levelno >= logging.WARNING or request_sampled.get()
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": datetime.datetime.fromtimestamp(
+                record.created, datetime.timezone.utc
+            ).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        path = getattr(record, "path", None)
+        if path is not None:
+            entry["path"] = path
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class RequestLogContext:
+    """ASGI middleware that tags log records with the path and samples requests."""
+
+    def __init__(self, app, sample_rates: Optional[Dict[str, float]] = None):
+        self.app = app
+        rates = sample_rates
+        if rates is None:
+            rates = parse_sample_rates(LOG_SAMPLE_RATES)
+        # Longest prefix first so "/pdfs" wins over "/pdf"
+        self.sample_rates = sorted(rates.items(), key=lambda item: -len(item[0]))
+
+    def _rate_for(self, path: str) -> float:
+        for prefix, rate in self.sample_rates:
+            if path.startswith(prefix):
+                return rate
+        return 1.0
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        path = scope["path"]
+        rate = self._rate_for(path)
+        path_token = current_path.set(path)
+        sampled_token = request_sampled.set(rate >= 1.0 or random.random() < rate)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            request_sampled.reset(sampled_token)
+            current_path.reset(path_token)
+
+
+def setup_logging() -> logging.Logger:
+    global _handler, _listener
+    root = logging.getLogger("rolsa")
+    if _handler is not None:
+        return root
+
+    level = logging.getLevelName(LOG_LEVEL)
+    if not isinstance(level, int):
+        level = logging.INFO
+    if not REQUEST_DEBUG_LOGGING:
+        level = max(level, logging.INFO)
+    root.setLevel(level)
+    root.propagate = False
+
+    output = logging.StreamHandler(sys.stdout)
+    if LOG_FORMAT == "json":
+        output.setFormatter(JsonFormatter())
+    else:
+        output.setFormatter(
+            logging.Formatter("%(asctime)s %(levelname)s %(name)s %(path)s %(message)s")
+        )
+
+    log_queue = queue.SimpleQueue()
+    _handler = DeferredQueueHandler(log_queue)
+    _handler.addFilter(SampledRequestFilter())
+    root.addHandler(_handler)
+
+    # Formatting and the stdout write happen on the listener's own thread
+    _listener = logging.handlers.QueueListener(log_queue, output)
+    _listener.start()
+    atexit.register(shutdown_logging)
+    return root
+
+
+def get_logger(name: str) -> logging.Logger:
+    setup_logging()
+    return logging.getLogger(f"rolsa.{name}")
+
+
+def shutdown_logging():
+    # Drains whatever is still queued before the process exits
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
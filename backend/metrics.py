@@ -0,0 +1,210 @@
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, List, Tuple
+
+# Upper bounds in seconds, the last bucket catches everything else
+LATENCY_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    float("inf"),
+)
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class Histogram:
+    __slots__ = ("counts", "total", "count")
+
+    def __init__(self):
+        self.counts = [0] * len(LATENCY_BUCKETS)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        # Linear interpolation inside the bucket the quantile falls into
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        lower = 0.0
+        for bound, bucket_count in zip(LATENCY_BUCKETS, self.counts):
+            if bucket_count and seen + bucket_count >= rank:
+                if bound == float("inf"):
+                    return lower
+                return lower + (bound - lower) * (rank - seen) / bucket_count
+            seen += bucket_count
+            lower = bound
+        return lower
+
+
+class Metrics:
+    # Only updated from the event loop, plain ints are enough
+    def __init__(self):
+        self.latency: Dict[Tuple[str, str], Histogram] = {}
+        self.requests: Dict[Tuple[str, str, int], int] = {}
+        self.bytes_in: Dict[str, int] = {}
+        self.bytes_out: Dict[str, int] = {}
+        self.timings: Dict[str, Histogram] = {}
+        self.in_flight = 0
+        self.collectors: List[Tuple[str, Callable[[], dict]]] = []
+
+    def observe_request(
+        self,
+        method: str,
+        route: str,
+        status: int,
+        seconds: float,
+        received: int,
+        sent: int,
+    ):
+        key = (method, route)
+        histogram = self.latency.get(key)
+        if histogram is None:
+            histogram = self.latency[key] = Histogram()
+        histogram.observe(seconds)
+        count_key = (method, route, status)
+        self.requests[count_key] = self.requests.get(count_key, 0) + 1
+        self.bytes_in[route] = self.bytes_in.get(route, 0) + received
+        self.bytes_out[route] = self.bytes_out.get(route, 0) + sent
+
+    def observe(self, name: str, seconds: float):
+        # For timing pieces that aren't routes, e.g. the auth dependency
+        histogram = self.timings.get(name)
+        if histogram is None:
+            histogram = self.timings[name] = Histogram()
+        histogram.observe(seconds)
+
+    def register(self, prefix: str, collector: Callable[[], dict]):
+        # collector returns {name: number}, read only when /metrics is scraped
+        self.collectors.append((prefix, collector))
+
+    def render(self) -> str:
+        lines = [
+            "# TYPE rolsa_http_request_duration_seconds histogram",
+        ]
+        for (method, route), histogram in sorted(self.latency.items()):
+            labels = f'method="{method}",route="{route}"'
+            _render_histogram(
+                lines, "rolsa_http_request_duration_seconds", labels, histogram
+            )
+        lines.append("# TYPE rolsa_http_request_duration_quantile_seconds gauge")
+        for (method, route), histogram in sorted(self.latency.items()):
+            for q in QUANTILES:
+                lines.append(
+                    "rolsa_http_request_duration_quantile_seconds"
+                    f'{{method="{method}",route="{route}",quantile="{q}"}} '
+                    f"{histogram.quantile(q):.6f}"
+                )
+
+        lines.append("# TYPE rolsa_http_requests_total counter")
+        for (method, route, status), count in sorted(self.requests.items()):
+            lines.append(
+                "rolsa_http_requests_total"
+                f'{{method="{method}",route="{route}",status="{status}"}} {count}'
+            )
+        lines.append("# TYPE rolsa_http_request_bytes_total counter")
+        for route, count in sorted(self.bytes_in.items()):
+            lines.append(f'rolsa_http_request_bytes_total{{route="{route}"}} {count}')
+        lines.append("# TYPE rolsa_http_response_bytes_total counter")
+        for route, count in sorted(self.bytes_out.items()):
+            lines.append(f'rolsa_http_response_bytes_total{{route="{route}"}} {count}')
+        lines.append("# TYPE rolsa_http_requests_in_flight gauge")
+        lines.append(f"rolsa_http_requests_in_flight {self.in_flight}")
+
+        lines.append("# TYPE rolsa_duration_seconds histogram")
+        for name, histogram in sorted(self.timings.items()):
+            _render_histogram(
+                lines, "rolsa_duration_seconds", f'name="{name}"', histogram
+            )
+        lines.append("# TYPE rolsa_duration_quantile_seconds gauge")
+        for name, histogram in sorted(self.timings.items()):
+            for q in QUANTILES:
+                lines.append(
+                    f'rolsa_duration_quantile_seconds{{name="{name}",quantile="{q}"}} '
+                    f"{histogram.quantile(q):.6f}"
+                )
+
+        for prefix, collector in self.collectors:
+            for name, value in collector().items():
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                metric = f"rolsa_{prefix}_{name}"
+                lines.append(f"# TYPE {metric} gauge")
+                lines.append(f"{metric} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def _render_histogram(lines: list, metric: str, labels: str, histogram: Histogram):
+    cumulative = 0
+    for bound, count in zip(LATENCY_BUCKETS, histogram.counts):
+        cumulative += count
+        le = "+Inf" if bound == float("inf") else repr(bound)
+        lines.append(f'{metric}_bucket{{{labels},le="{le}"}} {cumulative}')
+    lines.append(f"{metric}_sum{{{labels}}} {histogram.total:.6f}")
+    lines.append(f"{metric}_count{{{labels}}} {histogram.count}")
+
+
+metrics = Metrics()
+
+
+class MetricsMiddleware:
+    """ASGI middleware recording latency, status and body sizes per route."""
+
+    def __init__(self, app, registry: Metrics = metrics):
+        self.app = app
+        self.registry = registry
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        registry = self.registry
+        state = {"status": 500, "received": 0, "sent": 0}
+
+        async def counting_receive():
+            message = await receive()
+            if message["type"] == "http.request":
+                state["received"] += len(message.get("body", b""))
+            return message
+
+        async def counting_send(message):
+            if message["type"] == "http.response.start":
+                state["status"] = message["status"]
+            elif message["type"] == "http.response.body":
+                state["sent"] += len(message.get("body", b""))
+            await send(message)
+
+        registry.in_flight += 1
+        start = time.perf_counter()
+        try:
+            await self.app(scope, counting_receive, counting_send)
+        finally:
+            registry.in_flight -= 1
+            # The router leaves the matched route in the scope, using its
+            # template keeps ids out of the label values
+            route = scope.get("route")
+            registry.observe_request(
+                scope["method"],
+                getattr(route, "path", "unmatched"),
+                state["status"],
+                time.perf_counter() - start,
+                state["received"],
+                state["sent"],
+            )
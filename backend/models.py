@@ -3,14 +3,17 @@ from sqlalchemy import (
     create_engine,
     Column,
     Integer,
+    BigInteger,
     String,
     DateTime,
     Enum,
     ForeignKey,
     Date,
     DECIMAL,
+    Float,
     JSON,
     Text,
+    Index,
 )
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.sql import func
@@ -30,6 +33,36 @@ class User(Base):
     created_at = Column(DateTime, server_default=func.now())
 
 
+# There are no migrations, tables created before codecs were recorded need:
+#   ALTER TABLE documents ADD COLUMN codec VARCHAR(10);
+#   ALTER TABLE documents ADD COLUMN stored_size BIGINT;
+#   ALTER TABLE documents ADD COLUMN codec_ms FLOAT;
+# Existing rows keep NULLs there, their codec is then read off the blob. The
+# pdf_id tiebreaker of the listing index came later too:
+#   DROP INDEX ix_documents_user_created;  -- ON documents for MySQL
+#   CREATE INDEX ix_documents_user_created
+#     ON documents (user_id, created_at, pdf_id);
+class Document(Base):
+    __tablename__ = "documents"
+
+    pdf_id = Column(String(300), primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.user_id"), nullable=False)
+    filename = Column(String(255), nullable=False)
+    sha256 = Column(String(64), nullable=False, index=True)  # blob in the store
+    size = Column(BigInteger, nullable=False)
+    # How the blob sits on disk, see compression.py
+    codec = Column(String(10))
+    stored_size = Column(BigInteger)
+    codec_ms = Column(Float)
+    created_at = Column(DateTime, server_default=func.now(), nullable=False)
+
+    __table_args__ = (
+        # pdf_id breaks created_at ties in listings, see repository.SORT_COLUMNS
+        Index("ix_documents_user_created", "user_id", "created_at", "pdf_id"),
+        Index("ix_documents_user_filename", "user_id", "filename", "pdf_id"),
+    )
+
+
 class Property(Base):
     __tablename__ = "properties"
 
@@ -45,6 +78,18 @@ class Property(Base):
     created_at = Column(DateTime, server_default=func.now())
 
 
+# There are no migrations, tables created before slot locking need:
+#   ALTER TABLE consultations ADD COLUMN active_slot DATETIME;  -- TIMESTAMP on
+#     PostgreSQL
+#   UPDATE consultations SET active_slot = consultation_date
+#     WHERE status <> 'cancelled';
+#   CREATE UNIQUE INDEX uq_consultations_consultant_slot
+#     ON consultations (consultant_id, active_slot);
+# The index fails on slots already booked twice, these list them to cancel
+# the extras first:
+#   SELECT consultant_id, active_slot, COUNT(*) FROM consultations
+#     WHERE active_slot IS NOT NULL
+#     GROUP BY consultant_id, active_slot HAVING COUNT(*) > 1;
 class Consultation(Base):
     __tablename__ = "consultations"
 
@@ -55,6 +100,19 @@ class Consultation(Base):
     status = Column(Enum("scheduled", "completed", "cancelled"), nullable=False)
     notes = Column(Text)
     created_at = Column(DateTime, server_default=func.now())
+    # consultation_date while the booking holds its slot, NULL once cancelled
+    active_slot = Column(DateTime)
+
+    __table_args__ = (
+        # A consultant can hold a slot once. NULLs never collide in a unique
+        # index on any dialect, so cancelled rows don't block a rebooking
+        Index(
+            "uq_consultations_consultant_slot",
+            "consultant_id",
+            "active_slot",
+            unique=True,
+        ),
+    )
 
 
 class EnergyCalculation(Base):
@@ -77,6 +135,35 @@ class CarbonFootprint(Base):
     date = Column(DateTime, server_default=func.now())
 
 
+class CalculationRollup(Base):
+    # Sums of energy_calculation and carbon_footprint per property or user and
+    # per day or month, kept up to date by rollups.py
+    __tablename__ = "calculation_rollups"
+
+    scope = Column(String(10), primary_key=True)  # "property" or "user"
+    scope_id = Column(Integer, primary_key=True)
+    period = Column(String(5), primary_key=True)  # "day" or "month"
+    period_start = Column(Date, primary_key=True)
+    energy_consumption = Column(DECIMAL(14, 2), nullable=False, default=0)
+    energy_count = Column(Integer, nullable=False, default=0)
+    carbon_released = Column(DECIMAL(14, 2), nullable=False, default=0)
+    carbon_count = Column(Integer, nullable=False, default=0)
+
+
+# There are no migrations, tables created before delta versions need:
+#   ALTER TABLE legal_documents ALTER COLUMN content DROP NOT NULL;  -- PostgreSQL
+#   ALTER TABLE legal_documents MODIFY content TEXT NULL;  -- MySQL
+#   ALTER TABLE legal_documents ADD COLUMN base_document_id INTEGER
+#     REFERENCES legal_documents (document_id);
+#   ALTER TABLE legal_documents ADD COLUMN delta TEXT;
+#   CREATE INDEX ix_legal_documents_latest
+#     ON legal_documents (title, document_type, status, document_id);
+#   CREATE INDEX ix_legal_documents_expiry ON legal_documents (status, expiry_date);
+#   CREATE INDEX ix_legal_documents_base ON legal_documents (base_document_id);
+# SQLite can't drop NOT NULL in place, copy the table into a new one created
+# from this model instead. MySQL ignores an inline REFERENCES, add the foreign
+# key with ADD FOREIGN KEY (base_document_id) REFERENCES legal_documents
+# (document_id).
 class LegalDocument(Base):
     __tablename__ = "legal_documents"
 
@@ -86,7 +173,11 @@ class LegalDocument(Base):
         nullable=False,
     )
     title = Column(String(255), nullable=False)
-    content = Column(Text, nullable=False)
+    # Full text for snapshots, NULL for revisions stored as a delta
+    content = Column(Text)
+    # Snapshot the delta applies to, see legal.py
+    base_document_id = Column(Integer, ForeignKey("legal_documents.document_id"))
+    delta = Column(Text)
     version = Column(String(50), nullable=False)
     status = Column(Enum("active", "archived"), nullable=False)
     expiry_date = Column(Date)
@@ -95,6 +186,19 @@ class LegalDocument(Base):
     last_modified_by = Column(Integer, ForeignKey("users.user_id"))
     last_modified_at = Column(DateTime, onupdate=func.now())
 
+    __table_args__ = (
+        # Latest version per title and type is the highest id in the group
+        Index(
+            "ix_legal_documents_latest",
+            "title",
+            "document_type",
+            "status",
+            "document_id",
+        ),
+        Index("ix_legal_documents_expiry", "status", "expiry_date"),
+        Index("ix_legal_documents_base", "base_document_id"),
+    )
+
 
 class Employee(Base):
     __tablename__ = "employees"
@@ -123,6 +227,11 @@ class CustomerTicket(Base):
     updated_at = Column(DateTime, onupdate=func.now())
     resolved_at = Column(DateTime)
 
+    __table_args__ = (
+        # Dispatch order: open tickets by priority, oldest first
+        Index("ix_customer_tickets_queue", "status", "priority", "created_at"),
+    )
+
 
 class NewsletterSubscription(Base):
     __tablename__ = "newsletter_subscriptions"
@@ -0,0 +1,417 @@
+import argparse
+import asyncio
+import collections
+import json
+import os
+import smtplib
+import time
+from email.message import EmailMessage
+from typing import AsyncIterator, Dict, Optional, Set
+
+from sqlalchemy import select
+
+import models
+from database import AsyncSessionLocal
+from logger import get_logger, setup_logging
+
+log = get_logger("newsletter")
+
+# Campaigns go to an SMTP relay. For local runs point it at a stand-in such as
+# `python -m aiosmtpd -n -l localhost:1025`, which is the default address.
+SMTP_HOST = os.getenv("SMTP_HOST", "localhost")
+SMTP_PORT = int(os.getenv("SMTP_PORT", "1025"))
+SMTP_USER = os.getenv("SMTP_USER")
+SMTP_PASSWORD = os.getenv("SMTP_PASSWORD")
+SMTP_STARTTLS = os.getenv("SMTP_STARTTLS", "false").lower() == "true"
+SMTP_FROM = os.getenv("SMTP_FROM", "newsletter@rolsa.example")
+
+NEWSLETTER_CONCURRENCY = int(os.getenv("NEWSLETTER_CONCURRENCY", "8"))
+NEWSLETTER_RATE = float(os.getenv("NEWSLETTER_RATE", "50"))  # messages per second
+NEWSLETTER_PAGE_SIZE = int(os.getenv("NEWSLETTER_PAGE_SIZE", "1000"))
+NEWSLETTER_STATE_DIR = os.getenv(
+    "NEWSLETTER_STATE_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "newsletter_state"),
+)
+CHECKPOINT_INTERVAL = float(os.getenv("NEWSLETTER_CHECKPOINT_INTERVAL", "5"))
+MAX_ATTEMPTS = 3
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        self.rate = rate
+        self.burst = burst or max(rate, 1.0)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        # Waiters queue up behind the lock, so they're served in order
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.burst, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class Checkpoint:
+    """Campaign progress: a JSON snapshot plus a journal of sends since it.
+
+    Each send is journalled before it starts and again when it finishes, so
+    a crashed run resumes without sending anything twice. A send that was
+    cut off mid-flight can't be told apart from a delivered one and is
+    counted as unconfirmed rather than retried. The snapshot keeps the
+    watermark, the highest subscription_id below which everything is done,
+    and the few finished ids above it.
+    """
+
+    def __init__(self, campaign: str, state_dir: str = NEWSLETTER_STATE_DIR):
+        os.makedirs(state_dir, exist_ok=True)
+        self.path = os.path.join(state_dir, f"{campaign}.json")
+        self.journal_path = os.path.join(state_dir, f"{campaign}.log")
+        self.campaign = campaign
+        self.watermark = 0
+        self.completed: Set[int] = set()
+        self.sent = 0
+        self.failed = 0
+        self.unconfirmed = 0
+        self.done = False
+        self.meta: dict = {}
+        self._dispatched: collections.deque = collections.deque()
+        self._finished: Set[int] = set()
+        # Started but not finished, kept in the snapshot as the journal's
+        # "sending" lines are truncated with everything else
+        self._sending: Set[int] = set()
+        self._journal = None
+
+    def load(self):
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                state = json.load(f)
+            self.watermark = state["watermark"]
+            self.completed = set(state["completed"])
+            self.sent = state["sent"]
+            self.failed = state["failed"]
+            self.unconfirmed = state.get("unconfirmed", 0)
+            self.done = state["done"]
+            self.meta = state.get("meta", {})
+            started = set(state.get("sending", []))
+        else:
+            started = set()
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path) as f:
+                for line in f:
+                    outcome, _, subscription_id = line.strip().partition(" ")
+                    if not subscription_id.isdigit():
+                        continue  # torn last line
+                    subscription_id = int(subscription_id)
+                    if subscription_id <= self.watermark:
+                        continue
+                    if outcome == "sending":
+                        started.add(subscription_id)
+                        continue
+                    started.discard(subscription_id)
+                    if subscription_id not in self.completed:
+                        self.completed.add(subscription_id)
+                        self.sent += outcome == "sent"
+                        self.failed += outcome == "failed"
+        started -= self.completed
+        self.completed |= started
+        self.unconfirmed += len(started)
+        self._journal = open(self.journal_path, "a")
+
+    def dispatch(self, subscription_id: int):
+        self._dispatched.append(subscription_id)
+
+    def _write(self, outcome: str, subscription_id: int):
+        # Flushed to the OS straight away, a crashed process loses nothing
+        self._journal.write(f"{outcome} {subscription_id}\n")
+        self._journal.flush()
+
+    def start(self, subscription_id: int):
+        self._write("sending", subscription_id)
+        self._sending.add(subscription_id)
+
+    def finish(self, subscription_id: int, outcome: Optional[str]):
+        # outcome None is a subscriber the filter skipped, no need to journal it
+        if outcome is not None:
+            self._write(outcome, subscription_id)
+            self._sending.discard(subscription_id)
+            self.sent += outcome == "sent"
+            self.failed += outcome == "failed"
+            self.completed.add(subscription_id)
+        self._finished.add(subscription_id)
+        dispatched = self._dispatched
+        while dispatched and dispatched[0] in self._finished:
+            finished = dispatched.popleft()
+            self._finished.discard(finished)
+            self.completed.discard(finished)
+            self.watermark = finished
+
+    def save(self):
+        state = {
+            "campaign": self.campaign,
+            "watermark": self.watermark,
+            "completed": sorted(self.completed),
+            "sent": self.sent,
+            "failed": self.failed,
+            "unconfirmed": self.unconfirmed,
+            "sending": sorted(self._sending),
+            "done": self.done,
+            "meta": self.meta,
+        }
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        # Everything journalled so far is in the snapshot now
+        self._journal.truncate(0)
+        self._journal.seek(0)
+
+    def close(self):
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+    def stats(self) -> dict:
+        return {
+            "campaign": self.campaign,
+            "watermark": self.watermark,
+            "sent": self.sent,
+            "failed": self.failed,
+            "unconfirmed": self.unconfirmed,
+            "done": self.done,
+        }
+
+
+def matches(preferences: Optional[dict], wanted: Dict[str, str]) -> bool:
+    """Every wanted key must equal, or be listed in, the subscriber's value."""
+    preferences = preferences or {}
+    for key, value in wanted.items():
+        have = preferences.get(key)
+        if isinstance(have, list):
+            if value not in [str(item) for item in have]:
+                return False
+        elif str(have) != value:
+            return False
+    return True
+
+
+async def subscribers(after_id: int, page_size: int) -> AsyncIterator[tuple]:
+    subscription = models.NewsletterSubscription
+    query = (
+        select(
+            subscription.subscription_id,
+            subscription.email,
+            subscription.preferences,
+        )
+        .where(
+            subscription.status == "active",
+            subscription.subscription_id > after_id,
+        )
+        .order_by(subscription.subscription_id)
+        .execution_options(yield_per=page_size)
+    )
+    # Server side cursor, one page of subscribers in memory at a time
+    async with AsyncSessionLocal() as session:
+        result = await session.stream(query)
+        async for rows in result.partitions():
+            for row in rows:
+                yield row
+
+
+class Mailer:
+    """One SMTP connection, used from one worker at a time."""
+
+    def __init__(self, host: str = SMTP_HOST, port: int = SMTP_PORT):
+        self.host = host
+        self.port = port
+        self._smtp: Optional[smtplib.SMTP] = None
+
+    def send(self, message: EmailMessage):
+        if self._smtp is None:
+            smtp = smtplib.SMTP(self.host, self.port, timeout=30)
+            if SMTP_STARTTLS:
+                smtp.starttls()
+            if SMTP_USER:
+                smtp.login(SMTP_USER, SMTP_PASSWORD or "")
+            self._smtp = smtp
+        self._smtp.send_message(message)
+
+    def reset(self):
+        smtp, self._smtp = self._smtp, None
+        if smtp is not None:
+            try:
+                smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                smtp.close()
+
+    close = reset
+
+
+def build_message(subject: str, body: str, recipient: str) -> EmailMessage:
+    message = EmailMessage()
+    message["From"] = SMTP_FROM
+    message["To"] = recipient
+    message["Subject"] = subject
+    message["List-Unsubscribe"] = f"<mailto:{SMTP_FROM}?subject=unsubscribe>"
+    message.set_content(body)
+    return message
+
+
+async def deliver(
+    mailer: Mailer, bucket: TokenBucket, message: EmailMessage
+) -> str:
+    for attempt in range(MAX_ATTEMPTS):
+        await bucket.acquire()
+        try:
+            await asyncio.to_thread(mailer.send, message)
+            return "sent"
+        except smtplib.SMTPRecipientsRefused:
+            return "failed"
+        except smtplib.SMTPResponseException as e:
+            if 500 <= e.smtp_code < 600:
+                return "failed"  # permanent, retrying won't help
+            mailer.reset()
+        except (smtplib.SMTPException, OSError):
+            mailer.reset()
+        await asyncio.sleep(2**attempt)
+    return "failed"
+
+
+async def run_campaign(
+    campaign: str,
+    subject: str,
+    body: str,
+    wanted: Dict[str, str],
+    concurrency: int = NEWSLETTER_CONCURRENCY,
+    rate: float = NEWSLETTER_RATE,
+    page_size: int = NEWSLETTER_PAGE_SIZE,
+    state_dir: str = NEWSLETTER_STATE_DIR,
+) -> dict:
+    checkpoint = Checkpoint(campaign, state_dir)
+    checkpoint.load()
+    if checkpoint.done:
+        checkpoint.close()
+        return checkpoint.stats()
+    checkpoint.meta = {"subject": subject, "filter": wanted}
+    log.info(
+        "Campaign %s starting after subscriber %d (%d sent so far)",
+        campaign,
+        checkpoint.watermark,
+        checkpoint.sent,
+    )
+
+    bucket = TokenBucket(rate)
+    # Bounded, so paging only runs a little ahead of delivery
+    queue: asyncio.Queue = asyncio.Queue(maxsize=concurrency * 2)
+
+    async def worker():
+        mailer = Mailer()
+        try:
+            while True:
+                item = await queue.get()
+                if item is None:
+                    return
+                subscription_id, email = item
+                message = build_message(subject, body, email)
+                checkpoint.start(subscription_id)
+                outcome = await deliver(mailer, bucket, message)
+                checkpoint.finish(subscription_id, outcome)
+        finally:
+            await asyncio.to_thread(mailer.close)
+
+    async def checkpointer():
+        while True:
+            await asyncio.sleep(CHECKPOINT_INTERVAL)
+            checkpoint.save()
+            log.info("Campaign %s progress: %s", campaign, checkpoint.stats())
+
+    workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+    saver = asyncio.create_task(checkpointer())
+    try:
+        async for subscription_id, email, preferences in subscribers(
+            checkpoint.watermark, page_size
+        ):
+            if subscription_id in checkpoint.completed:
+                continue
+            checkpoint.dispatch(subscription_id)
+            if not matches(preferences, wanted):
+                checkpoint.finish(subscription_id, None)
+                continue
+            await queue.put((subscription_id, email))
+        for _ in workers:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+        checkpoint.done = True
+    finally:
+        saver.cancel()
+        for task in workers:
+            task.cancel()
+        checkpoint.save()
+        checkpoint.close()
+    return checkpoint.stats()
+
+
+def parse_filter(values) -> Dict[str, str]:
+    wanted = {}
+    for value in values or []:
+        key, _, expected = value.partition("=")
+        wanted[key] = expected
+    return wanted
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m newsletter")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    send_parser = commands.add_parser("send", help="send or resume a campaign")
+    send_parser.add_argument("campaign", help="campaign id, reused to resume")
+    send_parser.add_argument("--subject", required=True)
+    send_parser.add_argument("--body-file", required=True)
+    send_parser.add_argument(
+        "--filter", action="append", help="preference key=value, repeatable"
+    )
+    send_parser.add_argument(
+        "--concurrency", type=int, default=NEWSLETTER_CONCURRENCY
+    )
+    send_parser.add_argument("--rate", type=float, default=NEWSLETTER_RATE)
+    send_parser.add_argument("--page-size", type=int, default=NEWSLETTER_PAGE_SIZE)
+
+    status_parser = commands.add_parser("status", help="show campaign progress")
+    status_parser.add_argument("campaign")
+
+    args = parser.parse_args()
+    setup_logging()
+    if args.command == "status":
+        checkpoint = Checkpoint(args.campaign)
+        checkpoint.load()
+        checkpoint.close()
+        print(json.dumps(checkpoint.stats(), indent=2))
+        return
+
+    with open(args.body_file) as f:
+        body = f.read()
+    summary = asyncio.run(
+        run_campaign(
+            args.campaign,
+            args.subject,
+            body,
+            parse_filter(args.filter),
+            args.concurrency,
+            args.rate,
+            args.page_size,
+        )
+    )
+    print(json.dumps(summary, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,522 @@
+import base64
+import datetime
+import json
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import delete, func, or_, select, tuple_, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import audit
+import models
+import rollups
+
+# The app logs in with a username, it is stored in the email column of users
+
+# Columns GET /pdfs can be sorted by, pdf_id breaks ties so the order is total
+SORT_COLUMNS = {
+    "created_at": models.Document.created_at,
+    "filename": models.Document.filename,
+}
+
+
+async def get_user(db: AsyncSession, username: str) -> Optional[models.User]:
+    result = await db.execute(
+        select(models.User).where(models.User.email == username)
+    )
+    return result.scalar_one_or_none()
+
+
+async def create_user(
+    db: AsyncSession, username: str, password_hash: str
+) -> models.User:
+    user = models.User(
+        email=username,
+        password_hash=password_hash,
+        first_name="",
+        last_name="",
+        user_type="customer",
+    )
+    db.add(user)
+    await db.commit()
+    return user
+
+
+async def set_password_hash(db: AsyncSession, user: models.User, password_hash: str):
+    user.password_hash = password_hash
+    await db.commit()
+
+
+async def add_document(
+    db: AsyncSession,
+    user_id: int,
+    pdf_id: str,
+    filename: str,
+    sha256: str,
+    size: int,
+    codec: Optional[str] = None,
+    stored_size: Optional[int] = None,
+    codec_ms: Optional[float] = None,
+) -> models.Document:
+    document = models.Document(
+        pdf_id=pdf_id,
+        user_id=user_id,
+        filename=filename,
+        sha256=sha256,
+        size=size,
+        codec=codec,
+        stored_size=stored_size,
+        codec_ms=codec_ms,
+        # Set here rather than by the server so it keeps sub-second ordering
+        created_at=datetime.datetime.utcnow(),
+    )
+    db.add(document)
+    await db.commit()
+    return document
+
+
+async def add_documents(
+    db: AsyncSession, user_id: int, records: List[dict]
+) -> List[models.Document]:
+    # Batch uploads land in one transaction instead of a commit per file
+    documents = [
+        models.Document(
+            pdf_id=record["pdf_id"],
+            user_id=user_id,
+            filename=record["filename"],
+            sha256=record["sha256"],
+            size=record["size"],
+            codec=record.get("codec"),
+            stored_size=record.get("stored_size"),
+            codec_ms=record.get("codec_ms"),
+            created_at=datetime.datetime.utcnow(),
+        )
+        for record in records
+    ]
+    db.add_all(documents)
+    await db.commit()
+    return documents
+
+
+def encode_cursor(sort: str, descending: bool, value, pdf_id: str) -> str:
+    if isinstance(value, datetime.datetime):
+        value = value.isoformat()
+    raw = json.dumps([sort, descending, value, pdf_id]).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii")
+
+
+def decode_cursor(cursor: str, sort: str, descending: bool) -> Tuple[object, str]:
+    """Raises ValueError when the cursor is malformed or from another ordering."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode("ascii"))
+        cursor_sort, cursor_descending, value, pdf_id = json.loads(raw)
+    except Exception:
+        raise ValueError("Malformed cursor")
+    if cursor_sort != sort or cursor_descending != descending:
+        raise ValueError("Cursor does not match the requested sort order")
+    if sort == "created_at":
+        # A non string or garbled value would otherwise surface as a 500
+        try:
+            value = datetime.datetime.fromisoformat(value)
+        except (TypeError, ValueError):
+            raise ValueError("Malformed cursor")
+    return value, pdf_id
+
+
+async def list_documents(
+    db: AsyncSession,
+    username: str,
+    limit: int,
+    sort: str = "created_at",
+    descending: bool = False,
+    cursor: Optional[str] = None,
+    prefix: Optional[str] = None,
+) -> Tuple[List[dict], Optional[str]]:
+    """One page of a user's documents plus the cursor for the next page."""
+    column = SORT_COLUMNS[sort]
+    query = (
+        select(models.Document.pdf_id, models.Document.filename, column.label("key"))
+        .join(models.User, models.User.user_id == models.Document.user_id)
+        .where(models.User.email == username)
+    )
+    if prefix:
+        # LIKE matches the prefix under any collation, the lower bound lets
+        # the (user_id, filename) index seek where LIKE alone can't use it
+        query = query.where(
+            models.Document.filename >= prefix,
+            models.Document.filename.startswith(prefix, autoescape=True),
+        )
+    if cursor:
+        value, pdf_id = decode_cursor(cursor, sort, descending)
+        position = tuple_(column, models.Document.pdf_id)
+        query = query.where(
+            position < tuple_(value, pdf_id)
+            if descending
+            else position > tuple_(value, pdf_id)
+        )
+    if descending:
+        query = query.order_by(column.desc(), models.Document.pdf_id.desc())
+    else:
+        query = query.order_by(column, models.Document.pdf_id)
+
+    # One extra row tells us whether there is another page
+    rows = (await db.execute(query.limit(limit + 1))).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = encode_cursor(sort, descending, last.key, last.pdf_id)
+    documents = [{"pdf_id": row.pdf_id, "filename": row.filename} for row in rows]
+    return documents, next_cursor
+
+
+async def get_document(
+    db: AsyncSession, username: str, pdf_id: str
+) -> Optional[models.Document]:
+    result = await db.execute(
+        select(models.Document)
+        .join(models.User, models.User.user_id == models.Document.user_id)
+        .where(models.Document.pdf_id == pdf_id, models.User.email == username)
+    )
+    return result.scalar_one_or_none()
+
+
+async def delete_document(db: AsyncSession, document: models.Document):
+    await db.execute(
+        delete(models.Document).where(models.Document.pdf_id == document.pdf_id)
+    )
+    await db.commit()
+
+
+async def delete_user(db: AsyncSession, user: models.User) -> List[str]:
+    """Delete a user with everything they own, in one transaction.
+
+    Their documents, tickets and properties go, with the calculations and
+    consultations of those properties. Rows that only name them as staff keep
+    their history with the reference cleared, and bookings they were due to
+    run are cancelled. Returns the blobs the user's documents pointed at so
+    they can be released.
+    """
+    user_id = user.user_id
+    result = await db.execute(
+        select(models.Document.sha256).where(models.Document.user_id == user_id)
+    )
+    blobs = list(result.scalars())
+    properties = select(models.Property.property_id).where(
+        models.Property.user_id == user_id
+    )
+
+    # Core deletes skip the flush hook, so the rollups are taken down here
+    deltas: rollups.Deltas = {}
+    for model, value_column in (
+        (models.EnergyCalculation, models.EnergyCalculation.energy_consumption),
+        (models.CarbonFootprint, models.CarbonFootprint.carbon_released),
+    ):
+        owned = or_(model.user_id == user_id, model.property_id.in_(properties))
+        result = await db.execute(
+            select(model.property_id, model.user_id, value_column, model.date).where(
+                owned
+            )
+        )
+        for prop, owner, amount, date in result:
+            rollups.add_values(deltas, model, prop, owner, amount, date, -1)
+        await db.execute(delete(model).where(owned))
+    await db.run_sync(
+        lambda session: rollups.apply_deltas(session.connection(), deltas)
+    )
+
+    consultation = models.Consultation
+    await db.execute(
+        delete(consultation).where(consultation.property_id.in_(properties))
+    )
+    await db.execute(
+        update(consultation)
+        .where(
+            consultation.consultant_id == user_id,
+            consultation.status == "scheduled",
+        )
+        .values(status="cancelled", active_slot=None)
+    )
+    await db.execute(
+        update(consultation)
+        .where(consultation.consultant_id == user_id)
+        .values(consultant_id=None)
+    )
+    ticket = models.CustomerTicket
+    await db.execute(delete(ticket).where(ticket.user_id == user_id))
+    await db.execute(
+        update(ticket).where(ticket.assigned_to == user_id).values(assigned_to=None)
+    )
+    for column in (
+        models.LegalDocument.created_by,
+        models.LegalDocument.last_modified_by,
+        models.Employee.user_id,
+        models.AdminChange.admin_id,
+    ):
+        await db.execute(
+            update(column.class_).where(column == user_id).values({column: None})
+        )
+
+    await db.execute(delete(models.Document).where(models.Document.user_id == user_id))
+    await db.execute(delete(models.Property).where(models.Property.user_id == user_id))
+    await db.execute(delete(models.User).where(models.User.user_id == user_id))
+    await db.commit()
+    return blobs
+
+
+async def blob_ref_counts(db: AsyncSession) -> Dict[str, int]:
+    # Used to rebuild the blob store reference counts at startup
+    result = await db.execute(
+        select(models.Document.sha256, func.count()).group_by(models.Document.sha256)
+    )
+    return {sha256: count for sha256, count in result}
+
+
+async def get_property(db: AsyncSession, property_id: int) -> Optional[models.Property]:
+    return await db.get(models.Property, property_id)
+
+
+async def get_rollups(
+    db: AsyncSession,
+    scope: str,
+    scope_id: int,
+    period: str,
+    start: Optional[datetime.date] = None,
+    end: Optional[datetime.date] = None,
+) -> List[dict]:
+    # Primary key range scan over precomputed rows, never the calculation tables
+    rollup = models.CalculationRollup
+    query = select(rollup).where(
+        rollup.scope == scope, rollup.scope_id == scope_id, rollup.period == period
+    )
+    if start is not None:
+        query = query.where(rollup.period_start >= start)
+    if end is not None:
+        query = query.where(rollup.period_start <= end)
+    result = await db.execute(query.order_by(rollup.period_start))
+    return [
+        {
+            "period_start": row.period_start.isoformat(),
+            "energy_consumption": float(row.energy_consumption),
+            "energy_count": row.energy_count,
+            "carbon_released": float(row.carbon_released),
+            "carbon_count": row.carbon_count,
+        }
+        for row in result.scalars()
+    ]
+
+
+async def consultant_ids(db: AsyncSession) -> List[int]:
+    result = await db.execute(
+        select(models.User.user_id).where(models.User.user_type == "serviceman")
+    )
+    return list(result.scalars())
+
+
+async def scheduled_consultations(
+    db: AsyncSession, since: datetime.datetime
+) -> List[Tuple[int, datetime.datetime]]:
+    # Used to rebuild the scheduling index at startup and on every refresh
+    result = await db.execute(
+        select(
+            models.Consultation.consultant_id, models.Consultation.consultation_date
+        ).where(
+            models.Consultation.status == "scheduled",
+            models.Consultation.consultation_date >= since,
+        )
+    )
+    return [(consultant_id, when) for consultant_id, when in result]
+
+
+async def add_consultation(
+    db: AsyncSession,
+    property_id: int,
+    consultant_id: int,
+    when: datetime.datetime,
+    notes: Optional[str] = None,
+) -> models.Consultation:
+    consultation = models.Consultation(
+        property_id=property_id,
+        consultant_id=consultant_id,
+        consultation_date=when,
+        active_slot=when,
+        status="scheduled",
+        notes=notes,
+    )
+    db.add(consultation)
+    await db.commit()
+    return consultation
+
+
+async def get_consultation(
+    db: AsyncSession, consultation_id: int
+) -> Optional[models.Consultation]:
+    return await db.get(models.Consultation, consultation_id)
+
+
+async def cancel_consultation(db: AsyncSession, consultation_id: int) -> bool:
+    # Conditional so two cancellations can't both free the slot
+    result = await db.execute(
+        update(models.Consultation)
+        .where(
+            models.Consultation.consultation_id == consultation_id,
+            models.Consultation.status == "scheduled",
+        )
+        .values(status="cancelled", active_slot=None)
+    )
+    cancelled = result.rowcount == 1
+    if cancelled:
+        # Core update, the audit flush hook never sees it
+        await db.run_sync(
+            audit.record,
+            models.Consultation,
+            "update",
+            [(consultation_id, {"status": "scheduled"}, {"status": "cancelled"})],
+        )
+    await db.commit()
+    return cancelled
+
+
+async def open_tickets(
+    db: AsyncSession, since: Optional[datetime.datetime] = None
+) -> List[Tuple[int, str, datetime.datetime]]:
+    ticket = models.CustomerTicket
+    query = select(ticket.ticket_id, ticket.priority, ticket.created_at).where(
+        ticket.status == "open"
+    )
+    if since is not None:
+        query = query.where(ticket.created_at >= since)
+    result = await db.execute(query)
+    return [tuple(row) for row in result]
+
+
+async def add_ticket(
+    db: AsyncSession,
+    user_id: int,
+    category: str,
+    subject: str,
+    description: str,
+    priority: str,
+) -> models.CustomerTicket:
+    ticket = models.CustomerTicket(
+        user_id=user_id,
+        category=category,
+        subject=subject,
+        description=description,
+        priority=priority,
+        status="open",
+        # Set here so the dispatch queue can order it without a reload
+        created_at=datetime.datetime.utcnow(),
+    )
+    db.add(ticket)
+    await db.commit()
+    return ticket
+
+
+async def claim_ticket(db: AsyncSession, ticket_id: int, assignee: int) -> bool:
+    # Only one claimer can move a ticket out of "open", whoever sees
+    # rowcount 0 lost the race
+    result = await db.execute(
+        update(models.CustomerTicket)
+        .where(
+            models.CustomerTicket.ticket_id == ticket_id,
+            models.CustomerTicket.status == "open",
+        )
+        .values(
+            status="in_progress",
+            assigned_to=assignee,
+            updated_at=datetime.datetime.utcnow(),
+        )
+    )
+    await db.commit()
+    return result.rowcount == 1
+
+
+async def get_ticket(
+    db: AsyncSession, ticket_id: int
+) -> Optional[models.CustomerTicket]:
+    return await db.get(models.CustomerTicket, ticket_id)
+
+
+async def latest_legal_documents(
+    db: AsyncSession, keys: Optional[List[Tuple[str, str]]] = None
+) -> List[Tuple[str, str, int]]:
+    """(title, document_type, latest active document_id) per title and type."""
+    legal = models.LegalDocument
+    query = (
+        select(legal.title, legal.document_type, func.max(legal.document_id))
+        .where(legal.status == "active")
+        .group_by(legal.title, legal.document_type)
+    )
+    if keys is not None:
+        query = query.where(tuple_(legal.title, legal.document_type).in_(keys))
+    result = await db.execute(query)
+    return [tuple(row) for row in result]
+
+
+async def get_legal_document(
+    db: AsyncSession, document_id: int
+) -> Optional[models.LegalDocument]:
+    return await db.get(models.LegalDocument, document_id)
+
+
+async def legal_content(db: AsyncSession, document_id: int) -> Optional[str]:
+    result = await db.execute(
+        select(models.LegalDocument.content).where(
+            models.LegalDocument.document_id == document_id
+        )
+    )
+    return result.scalar_one_or_none()
+
+
+async def last_legal_version(
+    db: AsyncSession, title: str, document_type: str
+) -> Optional[models.LegalDocument]:
+    legal = models.LegalDocument
+    result = await db.execute(
+        select(legal)
+        .where(legal.title == title, legal.document_type == document_type)
+        .order_by(legal.document_id.desc())
+        .limit(1)
+    )
+    return result.scalar_one_or_none()
+
+
+async def legal_deltas_since(db: AsyncSession, base_document_id: int) -> int:
+    result = await db.execute(
+        select(func.count()).where(
+            models.LegalDocument.base_document_id == base_document_id
+        )
+    )
+    return result.scalar_one()
+
+
+async def add_legal_document(db: AsyncSession, **fields) -> models.LegalDocument:
+    document = models.LegalDocument(status="active", **fields)
+    db.add(document)
+    await db.commit()
+    return document
+
+
+async def archive_expired_legal_documents(
+    db: AsyncSession, today: datetime.date, limit: int
+) -> List[Tuple[int, str, str]]:
+    legal = models.LegalDocument
+    result = await db.execute(
+        select(legal.document_id, legal.title, legal.document_type)
+        .where(legal.status == "active", legal.expiry_date < today)
+        .order_by(legal.document_id)
+        .limit(limit)
+    )
+    rows = [tuple(row) for row in result]
+    if rows:
+        # Still conditional on status, another worker may have swept them
+        await db.execute(
+            update(legal)
+            .where(
+                legal.document_id.in_([row[0] for row in rows]),
+                legal.status == "active",
+            )
+            .values(status="archived", last_modified_at=datetime.datetime.utcnow())
+        )
+    await db.commit()
+    return rows
@@ -0,0 +1,279 @@
+import asyncio
+import json
+import os
+import threading
+import zlib
+from collections import OrderedDict
+from typing import Dict, Optional
+
+from fastapi.responses import JSONResponse
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import MutableHeaders
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", "1024"))
+COMPRESSION_LEVEL = int(os.getenv("COMPRESSION_LEVEL", "6"))  # gzip
+BROTLI_QUALITY = int(os.getenv("BROTLI_QUALITY", "4"))
+# Compressed bodies of immutable responses are kept up to this many bytes
+COMPRESSION_CACHE_BYTES = int(
+    os.getenv("COMPRESSION_CACHE_BYTES", str(64 * 1024 * 1024))
+)
+# Bodies at least this big are compressed off the event loop
+THREADPOOL_SIZE = 256 * 1024
+
+COMPRESSIBLE_TYPES = frozenset(
+    [
+        "application/json",
+        "application/x-ndjson",
+        "application/javascript",
+        "image/svg+xml",
+    ]
+)
+
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse rendered with orjson when it's installed."""
+
+    def render(self, content) -> bytes:
+        if orjson is not None:
+            return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+        return json.dumps(
+            content, ensure_ascii=False, allow_nan=False, separators=(",", ":")
+        ).encode("utf-8")
+
+
+def negotiate(accept_encoding: str) -> Optional[str]:
+    """Pick br or gzip from an Accept-Encoding header, None for identity."""
+    accepted = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip().lower()] = quality
+
+    for encoding in ("br", "gzip"):
+        if encoding == "br" and brotli is None:
+            continue
+        if accepted.get(encoding, accepted.get("*", 0.0)) > 0:
+            return encoding
+    return None
+
+
+def _opaque_tag(etag: str) -> str:
+    etag = etag.strip()
+    return etag[2:] if etag.startswith("W/") else etag
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """If-None-Match check, compared weakly as RFC 9110 asks."""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    opaque = _opaque_tag(etag)
+    return any(_opaque_tag(tag) == opaque for tag in if_none_match.split(","))
+
+
+class Encoder:
+    def __init__(self, encoding: str):
+        self.encoding = encoding
+        if encoding == "br":
+            self._engine = brotli.Compressor(quality=BROTLI_QUALITY)
+        else:
+            self._engine = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, 31)
+
+    def compress(self, data: bytes, final: bool) -> bytes:
+        # Streamed chunks are flushed as they go so clients see them promptly
+        if self.encoding == "br":
+            out = self._engine.process(data)
+            return out + (self._engine.finish() if final else self._engine.flush())
+        out = self._engine.compress(data)
+        return out + self._engine.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+
+
+def compress(data: bytes, encoding: str) -> bytes:
+    return Encoder(encoding).compress(data, True)
+
+
+class PrecompressedCache:
+    """LRU of compressed bodies for responses marked immutable with an ETag."""
+
+    def __init__(self, max_bytes: int = COMPRESSION_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[tuple, bytes]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: tuple) -> Optional[bytes]:
+        with self._lock:
+            body = self._entries.get(key)
+            if body is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return body
+
+    def put(self, key: tuple, body: bytes):
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous)
+            self._entries[key] = body
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.size,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+def compressible(status: int, headers: MutableHeaders) -> bool:
+    # Partial content, PDFs and anything already encoded go out untouched
+    if status < 200 or status in (204, 206, 304):
+        return False
+    if "content-encoding" in headers or "content-range" in headers:
+        return False
+    media_type = headers.get("content-type", "").split(";")[0].strip().lower()
+    return media_type.startswith("text/") or media_type in COMPRESSIBLE_TYPES
+
+
+class CompressionMiddleware:
+    """ASGI middleware negotiating gzip/br for compressible responses."""
+
+    def __init__(
+        self,
+        app,
+        minimum_size: int = COMPRESSION_MIN_SIZE,
+        cache: Optional[PrecompressedCache] = None,
+    ):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.cache = cache if cache is not None else PrecompressedCache()
+        self._building: Dict[tuple, asyncio.Future] = {}
+
+    async def _compress(self, body: bytes, encoding: str) -> bytes:
+        if len(body) >= THREADPOOL_SIZE:
+            return await run_in_threadpool(compress, body, encoding)
+        return compress(body, encoding)
+
+    async def _compress_body(self, body: bytes, encoding: str, key) -> bytes:
+        if key is None:
+            return await self._compress(body, encoding)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+        # Requests that miss together wait on the first one's compression
+        # rather than each compressing the same body
+        building = self._building.get(key)
+        if building is not None:
+            return await asyncio.shield(building)
+        building = asyncio.get_running_loop().create_future()
+        self._building[key] = building
+        try:
+            compressed = await self._compress(body, encoding)
+        except BaseException as exc:
+            building.set_exception(exc)
+            # Nobody else may be waiting, don't log it as never retrieved
+            building.exception()
+            raise
+        else:
+            self.cache.put(key, compressed)
+            building.set_result(compressed)
+            return compressed
+        finally:
+            del self._building[key]
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        accept_encoding = ""
+        for name, value in scope["headers"]:
+            if name == b"accept-encoding":
+                accept_encoding = value.decode("latin-1")
+                break
+        encoding = negotiate(accept_encoding)
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        state = {"start": None, "encoder": None, "passthrough": False}
+
+        async def compressing_send(message):
+            if message["type"] == "http.response.start":
+                # Held back until the first body chunk shows how big it is
+                state["start"] = message
+                return
+            if message["type"] != "http.response.body" or state["passthrough"]:
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            start = state["start"]
+            if start is not None:
+                state["start"] = None
+                headers = MutableHeaders(raw=list(start["headers"]))
+                start["headers"] = headers.raw
+                if not compressible(start["status"], headers) or (
+                    not more_body and len(body) < self.minimum_size
+                ):
+                    state["passthrough"] = True
+                    await send(start)
+                    await send(message)
+                    return
+
+                headers["Content-Encoding"] = encoding
+                vary = [v.strip().lower() for v in headers.get("vary", "").split(",")]
+                if "accept-encoding" not in vary:
+                    headers.add_vary_header("Accept-Encoding")
+                if not more_body:
+                    key = None
+                    etag = headers.get("etag")
+                    if etag and "immutable" in headers.get("cache-control", ""):
+                        key = (scope["path"], etag, encoding)
+                    body = await self._compress_body(body, encoding, key)
+                    headers["Content-Length"] = str(len(body))
+                    await send(start)
+                    await send({"type": "http.response.body", "body": body})
+                    return
+
+                # Streamed, the final length isn't known up front
+                del headers["Content-Length"]
+                state["encoder"] = Encoder(encoding)
+                await send(start)
+
+            chunk = state["encoder"].compress(body, not more_body)
+            await send(
+                {"type": "http.response.body", "body": chunk, "more_body": more_body}
+            )
+
+        await self.app(scope, receive, compressing_send)
+
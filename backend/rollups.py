@@ -0,0 +1,178 @@
+import argparse
+import datetime
+from typing import Dict, List, Tuple
+
+from sqlalchemy import and_, delete, event, func, select, update
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+
+import models
+
+# Every calculation row adds to four rollup rows: its property and its user,
+# each for the day and the month it falls in. Changes are collected as deltas
+# and upserted in the same transaction as the rows they come from.
+SCOPES = ("property", "user")
+PERIODS = ("day", "month")
+KEY_COLUMNS = ("scope", "scope_id", "period", "period_start")
+VALUE_COLUMNS = (
+    "energy_consumption",
+    "energy_count",
+    "carbon_released",
+    "carbon_count",
+)
+
+Key = Tuple[str, int, str, datetime.date]
+Deltas = Dict[Key, List[float]]
+
+
+def period_starts(day: datetime.date) -> Dict[str, datetime.date]:
+    return {"day": day, "month": day.replace(day=1)}
+
+
+def add_delta(
+    deltas: Deltas,
+    scope: str,
+    scope_id: int,
+    day: datetime.date,
+    energy: float = 0.0,
+    energy_count: int = 0,
+    carbon: float = 0.0,
+    carbon_count: int = 0,
+):
+    for period, start in period_starts(day).items():
+        values = deltas.setdefault((scope, scope_id, period, start), [0.0, 0, 0.0, 0])
+        values[0] += energy
+        values[1] += energy_count
+        values[2] += carbon
+        values[3] += carbon_count
+
+
+def add_values(
+    deltas: Deltas,
+    model,
+    property_id: int,
+    user_id: int,
+    amount,
+    date: datetime.datetime,
+    sign: int = 1,
+):
+    """Add one energy_calculation or carbon_footprint row given as values."""
+    if model is models.EnergyCalculation:
+        value = dict(energy=sign * float(amount), energy_count=sign)
+    else:
+        value = dict(carbon=sign * float(amount), carbon_count=sign)
+    add_delta(deltas, "property", property_id, date.date(), **value)
+    add_delta(deltas, "user", user_id, date.date(), **value)
+
+
+def add_calculation(deltas: Deltas, row, sign: int = 1):
+    # ORM rows straight from a flush, date may still be left to the server
+    date = row.__dict__.get("date") or datetime.datetime.utcnow()
+    if isinstance(row, models.EnergyCalculation):
+        amount = row.energy_consumption
+    else:
+        amount = row.carbon_released
+    add_values(deltas, type(row), row.property_id, row.user_id, amount, date, sign)
+
+
+def apply_deltas(connection, deltas: Deltas):
+    """Upsert deltas into calculation_rollups on the caller's connection."""
+    if not deltas:
+        return
+    table = models.CalculationRollup.__table__
+    rows = [
+        dict(zip(KEY_COLUMNS, key), **dict(zip(VALUE_COLUMNS, values)))
+        for key, values in deltas.items()
+    ]
+    for row in rows:
+        row["energy_consumption"] = round(row["energy_consumption"], 2)
+        row["carbon_released"] = round(row["carbon_released"], 2)
+
+    dialect = connection.dialect.name
+    if dialect in ("sqlite", "postgresql"):
+        insert = sqlite_insert if dialect == "sqlite" else postgresql_insert
+        statement = insert(table)
+        statement = statement.on_conflict_do_update(
+            index_elements=list(KEY_COLUMNS),
+            set_={c: table.c[c] + statement.excluded[c] for c in VALUE_COLUMNS},
+        )
+        connection.execute(statement, rows)
+    elif dialect in ("mysql", "mariadb"):
+        statement = mysql_insert(table)
+        statement = statement.on_duplicate_key_update(
+            {c: table.c[c] + statement.inserted[c] for c in VALUE_COLUMNS}
+        )
+        connection.execute(statement, rows)
+    else:
+        # No native upsert, update first and insert what wasn't there
+        for row in rows:
+            match = and_(*(table.c[c] == row[c] for c in KEY_COLUMNS))
+            result = connection.execute(
+                update(table)
+                .where(match)
+                .values({c: table.c[c] + row[c] for c in VALUE_COLUMNS})
+            )
+            if result.rowcount == 0:
+                connection.execute(table.insert().values(row))
+
+
+@event.listens_for(Session, "after_flush")
+def track_calculations(session, flush_context):
+    # Runs for async sessions too, they flush through a sync Session
+    deltas: Deltas = {}
+    for sign, rows in ((1, session.new), (-1, session.deleted)):
+        for row in rows:
+            if isinstance(row, (models.EnergyCalculation, models.CarbonFootprint)):
+                add_calculation(deltas, row, sign)
+    apply_deltas(session.connection(), deltas)
+
+
+def rebuild(db: Session) -> int:
+    """Recompute every rollup from the calculation tables, returns rows written."""
+    day = func.date
+    sources = (
+        (models.EnergyCalculation, models.EnergyCalculation.energy_consumption, 0),
+        (models.CarbonFootprint, models.CarbonFootprint.carbon_released, 2),
+    )
+    deltas: Deltas = {}
+    for model, column, slot in sources:
+        owners = (("property", model.property_id), ("user", model.user_id))
+        for scope, owner in owners:
+            # Summed per day in the database, months are folded from the days
+            query = select(
+                owner, day(model.date), func.sum(column), func.count()
+            ).group_by(owner, day(model.date))
+            for scope_id, bucket, total, count in db.execute(query):
+                if isinstance(bucket, str):
+                    bucket = datetime.date.fromisoformat(bucket[:10])
+                elif isinstance(bucket, datetime.datetime):
+                    bucket = bucket.date()
+                values = [0.0, 0, 0.0, 0]
+                values[slot] = float(total or 0)
+                values[slot + 1] = count
+                add_delta(deltas, scope, scope_id, bucket, *values)
+
+    db.execute(delete(models.CalculationRollup))
+    apply_deltas(db.connection(), deltas)
+    db.commit()
+    return len(deltas)
+
+
+def main():
+    from database import SessionLocal
+
+    parser = argparse.ArgumentParser(prog="python -m rollups")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("rebuild", help="recompute all rollups from scratch")
+    parser.parse_args()
+
+    with SessionLocal() as session:
+        models.Base.metadata.create_all(bind=session.get_bind())
+        rows = rebuild(session)
+    print(f"Rebuilt {rows} rollup rows")
+
+
+if __name__ == "__main__":
+    main()
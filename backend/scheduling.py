@@ -0,0 +1,202 @@
+import asyncio
+import bisect
+import datetime
+import heapq
+import itertools
+import os
+import threading
+import time
+from typing import Awaitable, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from logger import get_logger
+
+log = get_logger("scheduling")
+
+# Consultations are fixed length slots inside working hours on weekdays. Each
+# consultant's bookings are a sorted list of start times, so a conflict check
+# is a bisect and free slots come from walking the candidate slots past it.
+CONSULTATION_MINUTES = int(os.getenv("CONSULTATION_MINUTES", "60"))
+WORKDAY_START = int(os.getenv("WORKDAY_START", "9"))  # hour, UTC
+WORKDAY_END = int(os.getenv("WORKDAY_END", "17"))
+WORKDAYS = frozenset(range(5))  # Monday to Friday
+MAX_WINDOW_DAYS = int(os.getenv("SCHEDULE_MAX_WINDOW_DAYS", "92"))
+# How often consultants and bookings from other workers are reloaded
+SCHEDULE_REFRESH_INTERVAL = float(os.getenv("SCHEDULE_REFRESH_INTERVAL", "30"))
+# A local claim the database hasn't shown yet is kept across reloads this long
+CLAIM_TTL = 300
+
+Booking = Tuple[int, datetime.datetime]  # consultant_id, start
+# Consultant ids and scheduled bookings, read from the database
+Fetch = Callable[[], Awaitable[Tuple[List[int], List[Booking]]]]
+
+
+class SlotUnavailable(Exception):
+    pass
+
+
+def normalize(when: datetime.datetime) -> datetime.datetime:
+    # Stored datetimes are naive UTC
+    if when.tzinfo is not None:
+        when = when.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return when
+
+
+class Schedule:
+    def __init__(self, minutes: int = CONSULTATION_MINUTES):
+        self.length = datetime.timedelta(minutes=minutes)
+        self._booked: Dict[int, List[datetime.datetime]] = {}
+        # Slots reserved here that no reload has seen in the database yet
+        self._claims: Dict[Booking, float] = {}
+        self._lock = threading.Lock()
+        self._task = None
+        self.refreshes = 0
+
+    def load(self, consultant_ids: Iterable[int], bookings: Iterable[Booking]):
+        booked: Dict[int, List[datetime.datetime]] = {c: [] for c in consultant_ids}
+        for consultant_id, start in bookings:
+            booked.setdefault(consultant_id, []).append(start)
+        with self._lock:
+            # Bookings still being written would otherwise vanish until the
+            # next reload, and be offered again in the meantime
+            expired = time.monotonic() - CLAIM_TTL
+            for claim, claimed_at in list(self._claims.items()):
+                consultant_id, start = claim
+                starts = booked.get(consultant_id)
+                if starts is None or start in starts or claimed_at < expired:
+                    del self._claims[claim]
+                else:
+                    starts.append(start)
+            for starts in booked.values():
+                starts.sort()
+            self._booked = booked
+
+    async def refresh(self, fetch: Fetch):
+        consultant_ids, bookings = await fetch()
+        self.load(consultant_ids, bookings)
+        self.refreshes += 1
+
+    async def _maintain(self, fetch: Fetch):
+        while True:
+            await asyncio.sleep(SCHEDULE_REFRESH_INTERVAL)
+            try:
+                await self.refresh(fetch)
+            except Exception:
+                log.exception("Refreshing the schedule failed")
+
+    def start(self, fetch: Fetch):
+        self._task = asyncio.get_running_loop().create_task(self._maintain(fetch))
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def has_consultant(self, consultant_id: int) -> bool:
+        return consultant_id in self._booked
+
+    def add_consultant(self, consultant_id: int):
+        with self._lock:
+            self._booked.setdefault(consultant_id, [])
+
+    def aligned(self, start: datetime.datetime) -> bool:
+        if start.weekday() not in WORKDAYS or start.second or start.microsecond:
+            return False
+        opening = start.replace(hour=WORKDAY_START, minute=0)
+        closing = start.replace(hour=0, minute=0) + datetime.timedelta(
+            hours=WORKDAY_END
+        )
+        offset = start - opening
+        return (
+            offset >= datetime.timedelta(0)
+            and start + self.length <= closing
+            and offset % self.length == datetime.timedelta(0)
+        )
+
+    def _conflicts(self, starts: List[datetime.datetime], slot) -> bool:
+        # Any booking starting in (slot - length, slot + length) overlaps it,
+        # which also covers bookings made before slots were aligned
+        i = bisect.bisect_right(starts, slot - self.length)
+        return i < len(starts) and starts[i] < slot + self.length
+
+    def _candidates(self, start, end) -> Iterator[datetime.datetime]:
+        day = start.date()
+        while datetime.datetime.combine(day, datetime.time()) < end:
+            if day.weekday() in WORKDAYS:
+                slot = datetime.datetime.combine(day, datetime.time(WORKDAY_START))
+                closing = datetime.datetime.combine(
+                    day, datetime.time()
+                ) + datetime.timedelta(hours=WORKDAY_END)
+                while slot + self.length <= closing and slot < end:
+                    if slot >= start:
+                        yield slot
+                    slot += self.length
+            day += datetime.timedelta(days=1)
+
+    def _free(self, consultant_id: int, start, end):
+        starts = self._booked.get(consultant_id, [])
+        for slot in self._candidates(start, end):
+            if not self._conflicts(starts, slot):
+                yield slot, consultant_id
+
+    def next_free(
+        self,
+        start: datetime.datetime,
+        end: datetime.datetime,
+        limit: int,
+        consultant_ids: Optional[Iterable[int]] = None,
+    ) -> List[Tuple[datetime.datetime, int]]:
+        """Earliest free (slot, consultant_id) pairs in [start, end)."""
+        start, end = normalize(start), normalize(end)
+        end = min(end, start + datetime.timedelta(days=MAX_WINDOW_DAYS))
+        with self._lock:
+            if consultant_ids is None:
+                consultants = sorted(self._booked)
+            else:
+                consultants = list(consultant_ids)
+                for consultant_id in consultants:
+                    if consultant_id not in self._booked:
+                        raise ValueError(f"Unknown consultant {consultant_id}")
+            # Each consultant's free slots are already in order, merging them
+            # lazily only walks as far as the first `limit` results
+            streams = [self._free(c, start, end) for c in consultants]
+            return list(itertools.islice(heapq.merge(*streams), limit))
+
+    def free_consultants(self, start: datetime.datetime) -> List[int]:
+        with self._lock:
+            return [
+                consultant_id
+                for consultant_id, starts in sorted(self._booked.items())
+                if not self._conflicts(starts, start)
+            ]
+
+    def reserve(self, consultant_id: int, start: datetime.datetime):
+        """Claim a slot in the index, raises SlotUnavailable if it's taken."""
+        if not self.aligned(start):
+            raise ValueError("Consultations must start on a slot in working hours")
+        with self._lock:
+            starts = self._booked.get(consultant_id)
+            if starts is None:
+                raise ValueError(f"Unknown consultant {consultant_id}")
+            if self._conflicts(starts, start):
+                raise SlotUnavailable(
+                    f"Consultant {consultant_id} is booked at {start.isoformat()}"
+                )
+            bisect.insort(starts, start)
+            self._claims[(consultant_id, start)] = time.monotonic()
+
+    def release(self, consultant_id: int, start: datetime.datetime):
+        with self._lock:
+            self._claims.pop((consultant_id, start), None)
+            starts = self._booked.get(consultant_id, [])
+            i = bisect.bisect_left(starts, start)
+            if i < len(starts) and starts[i] == start:
+                del starts[i]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "consultants": len(self._booked),
+                "bookings": sum(len(starts) for starts in self._booked.values()),
+                "pending_claims": len(self._claims),
+                "refreshes": self.refreshes,
+            }
@@ -2,7 +2,6 @@ from pydantic import BaseModel
 from datetime import datetime
 from typing import Optional
 from enum import Enum
-import model
 
 
 class UserType(str, Enum):
@@ -41,12 +40,16 @@ class RoofProfile(str, Enum):
 
 class PropertyBase(BaseModel):
     address_line1: str
-    address_line2: Optional[str]
+    address_line2: Optional[str] = None
     city: str
     postcode: str
     property_type: str
-    roof_size: Optional[int]
-    roof_profile: Optional[RoofProfile]
+    roof_size: Optional[int] = None
+    roof_profile: Optional[RoofProfile] = None
+
+
+class PropertyCreate(PropertyBase):
+    user_id: int
 
 
 class Property(PropertyBase):
@@ -77,6 +80,13 @@ class Consultation(BaseModel):
         orm_mode = True
 
 
+class EnergyCalculationCreate(BaseModel):
+    user_id: int
+    property_id: int
+    energy_consumption: float
+    date: Optional[datetime] = None
+
+
 class EnergyCalculation(BaseModel):
     calculation_id: int
     user_id: int
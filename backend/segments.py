@@ -0,0 +1,509 @@
+import asyncio
+import itertools
+import mmap
+import os
+import struct
+import zlib
+from typing import Dict, List, Optional, Tuple
+
+import compression
+from storage import BLOB_DIR, CHUNK_SIZE, BlobStore
+
+# Blobs are appended to segment files instead of getting a file each. Every
+# record is a small header followed by the blob, whose payload always starts
+# with a codec header (compression.header), raw blobs included. A full
+# segment is sealed with a footer listing its records, so startup only reads
+# footers, and only the unsealed tail segment is walked record by record.
+SEGMENT_SIZE = int(os.getenv("SEGMENT_SIZE", str(256 * 1024 * 1024)))
+# Sealed segments with at least this share of dead bytes get rewritten
+SEGMENT_COMPACT_RATIO = float(os.getenv("SEGMENT_COMPACT_RATIO", "0.5"))
+SEGMENT_COMPACT_INTERVAL = float(os.getenv("SEGMENT_COMPACT_INTERVAL", "60"))
+
+SEGMENT_MAGIC = b"RSEG1\n"
+FOOTER_MAGIC = b"RSEGIDX1"
+RECORD = struct.Struct("<32sQI")  # sha256 digest, payload length, crc32
+ENTRY = struct.Struct("<32sQQ")  # sha256 digest, payload offset, payload length
+TRAILER = struct.Struct("<QQ8s")  # footer offset, entry count, magic
+
+Entry = Tuple[bytes, int, int]
+
+
+class ViewReader:
+    """File-like reads over a memoryview, slices share the mapped pages."""
+
+    def __init__(self, view: memoryview, position: int = 0):
+        self.view = view
+        self.position = position
+
+    def read(self, size: int) -> memoryview:
+        chunk = self.view[self.position : self.position + size]
+        self.position += len(chunk)
+        return chunk
+
+
+def read_segment(path: str) -> Tuple[List[Entry], int, bool]:
+    """Records of a segment file, where its records end and whether it's sealed."""
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if f.read(len(SEGMENT_MAGIC)) != SEGMENT_MAGIC:
+            return [], 0, False
+
+        if size >= len(SEGMENT_MAGIC) + TRAILER.size:
+            f.seek(size - TRAILER.size)
+            footer_offset, count, magic = TRAILER.unpack(f.read(TRAILER.size))
+            if (
+                magic == FOOTER_MAGIC
+                and footer_offset + count * ENTRY.size + TRAILER.size == size
+            ):
+                f.seek(footer_offset)
+                data = f.read(count * ENTRY.size)
+                entries = [
+                    ENTRY.unpack_from(data, i * ENTRY.size) for i in range(count)
+                ]
+                return entries, footer_offset, True
+
+        # No footer, the segment was still being written: walk the records and
+        # stop where the file ends mid-record. Headers are written before any
+        # later record is reserved, so a record whose payload never made it
+        # whole (a copy cut off by a crash) is skipped, not the end of the log
+        entries = []
+        position = len(SEGMENT_MAGIC)
+        while True:
+            f.seek(position)
+            head = f.read(RECORD.size)
+            if len(head) < RECORD.size:
+                break
+            digest, length, crc = RECORD.unpack(head)
+            offset = position + RECORD.size
+            if offset + length > size:
+                break
+            checksum = 0
+            left = length
+            while left:
+                chunk = f.read(min(CHUNK_SIZE, left))
+                checksum = zlib.crc32(chunk, checksum)
+                left -= len(chunk)
+            if checksum == crc:
+                entries.append((digest, offset, length))
+            position = offset + length
+        return entries, position, False
+
+
+def file_crc(
+    path: str, chunk_size: int = CHUNK_SIZE, prefix: bytes = b""
+) -> Tuple[int, int]:
+    crc = zlib.crc32(prefix)
+    size = len(prefix)
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                return size, crc
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+
+
+class SegmentStore(BlobStore):
+    """Log-structured blob store with mmap reads and background compaction."""
+
+    def __init__(
+        self,
+        root: str = BLOB_DIR,
+        chunk_size: int = CHUNK_SIZE,
+        codec: str = compression.STORAGE_CODEC,
+        level: int = compression.STORAGE_CODEC_LEVEL,
+        segment_size: int = SEGMENT_SIZE,
+    ):
+        super().__init__(root, chunk_size, codec, level)
+        self.segment_size = segment_size
+        self.segment_dir = os.path.join(root, "segments")
+        os.makedirs(self.segment_dir, exist_ok=True)
+        # blob_id -> (segment number, payload offset, payload length)
+        self._index: Dict[str, Tuple[int, int, int]] = {}
+        # Per segment {"size": bytes on disk, "dead": bytes of dropped records}
+        self._segments: Dict[int, dict] = {}
+        # Segments still taking writes: {"fd", "entries" published so far,
+        # "pending" copies in flight, "full" once no more can be reserved}
+        self._writing: Dict[int, dict] = {}
+        self._maps: Dict[int, mmap.mmap] = {}
+        # Full segments whose last copy is done, sealed once the lock is free
+        self._ready: List[int] = []
+        self._active = 0
+        self._task = None
+        self.compactions = 0
+        self.reclaimed_bytes = 0
+        self._load_segments()
+
+    def _segment_path(self, number: int) -> str:
+        return os.path.join(self.segment_dir, f"seg-{number:08d}.log")
+
+    def _load_segments(self):
+        numbers = sorted(
+            int(name[4:-4])
+            for name in os.listdir(self.segment_dir)
+            if name.startswith("seg-") and name.endswith(".log")
+        )
+        for number in numbers:
+            path = self._segment_path(number)
+            entries, end, sealed = read_segment(path)
+            if not sealed:
+                # Drop a torn tail, then seal it unless it becomes the active one
+                with open(path, "r+b") as f:
+                    if end == 0:
+                        f.write(SEGMENT_MAGIC)
+                        end = len(SEGMENT_MAGIC)
+                    f.truncate(end)
+                if number != numbers[-1]:
+                    fd = os.open(path, os.O_RDWR)
+                    try:
+                        self._write_footer(fd, entries, end)
+                    finally:
+                        os.close(fd)
+            # Records the footer doesn't list were dropped or never finished
+            live = sum(RECORD.size + length for _, _, length in entries)
+            self._segments[number] = {
+                "size": os.path.getsize(path),
+                "dead": end - len(SEGMENT_MAGIC) - live,
+            }
+            for digest, offset, length in entries:
+                self._index_record(digest.hex(), number, offset, length)
+
+        last = numbers[-1] if numbers else 0
+        if numbers and not sealed:
+            self._active = last
+            self._writing[last] = {
+                "fd": os.open(self._segment_path(last), os.O_RDWR),
+                "entries": entries,
+                "pending": 0,
+                "full": False,
+            }
+        else:
+            self._open_segment(last + 1)
+
+    def _index_record(self, blob_id: str, number: int, offset: int, length: int):
+        # A blob can be in two segments after an interrupted compaction, the
+        # newer copy wins
+        previous = self._index.get(blob_id)
+        if previous is not None:
+            self._segments[previous[0]]["dead"] += RECORD.size + previous[2]
+        self._index[blob_id] = (number, offset, length)
+
+    def _open_segment(self, number: int):
+        # Caller holds the lock
+        self._active = number
+        fd = os.open(
+            self._segment_path(number), os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644
+        )
+        os.pwrite(fd, SEGMENT_MAGIC, 0)
+        self._segments[number] = {"size": len(SEGMENT_MAGIC), "dead": 0}
+        self._writing[number] = {"fd": fd, "entries": [], "pending": 0, "full": False}
+
+    @staticmethod
+    def _write_footer(fd: int, entries: List[Entry], footer_offset: int) -> int:
+        footer = b"".join(ENTRY.pack(*entry) for entry in entries)
+        footer += TRAILER.pack(footer_offset, len(entries), FOOTER_MAGIC)
+        os.pwrite(fd, footer, footer_offset)
+        os.fsync(fd)
+        return footer_offset + len(footer)
+
+    def _seal_ready(self):
+        with self._lock:
+            ready, self._ready = self._ready, []
+        for number in ready:
+            self._seal(number)
+
+    def _seal(self, number: int):
+        # Only once a full segment has no copies left in flight, so nothing
+        # else touches it and the footer is written outside the lock
+        with self._lock:
+            writing = self._writing[number]
+            footer_offset = self._segments[number]["size"]
+        try:
+            size = self._write_footer(writing["fd"], writing["entries"], footer_offset)
+        finally:
+            os.close(writing["fd"])
+            # Compaction leaves segments alone until they're out of _writing
+            with self._lock:
+                del self._writing[number]
+        with self._lock:
+            self._segments[number]["size"] = size
+
+    def _reserve(self, blob_id: str, length: int, crc: int) -> Tuple[int, int, int]:
+        """Claim room for a record, returns (segment, payload offset, fd).
+
+        Caller holds the lock. Only the record header is written here, the
+        payload is copied outside the lock and published by _finish.
+        """
+        size = self._segments[self._active]["size"]
+        full = size + RECORD.size + length > self.segment_size
+        if full and size > len(SEGMENT_MAGIC):
+            writing = self._writing[self._active]
+            writing["full"] = True
+            if not writing["pending"]:
+                self._ready.append(self._active)
+            self._open_segment(self._active + 1)
+            size = len(SEGMENT_MAGIC)
+        writing = self._writing[self._active]
+        head = RECORD.pack(bytes.fromhex(blob_id), length, crc)
+        os.pwrite(writing["fd"], head, size)
+        writing["pending"] += 1
+        self._segments[self._active]["size"] = size + RECORD.size + length
+        return self._active, size + RECORD.size, writing["fd"]
+
+    def _finish(
+        self,
+        blob_id: str,
+        number: int,
+        offset: int,
+        length: int,
+        written: bool,
+        expected: Optional[tuple] = None,
+    ) -> bool:
+        """Publish a copied record unless it failed or went stale meanwhile."""
+        with self._lock:
+            writing = self._writing[number]
+            writing["pending"] -= 1
+            publish = written and (
+                expected is None or self._index.get(blob_id) == expected
+            )
+            if publish:
+                writing["entries"].append((bytes.fromhex(blob_id), offset, length))
+                self._index_record(blob_id, number, offset, length)
+            else:
+                self._segments[number]["dead"] += RECORD.size + length
+            if writing["full"] and not writing["pending"]:
+                self._ready.append(number)
+        self._seal_ready()
+        return publish
+
+    def _copy(
+        self,
+        blob_id: str,
+        reserved: Tuple[int, int, int],
+        length: int,
+        chunks,
+        expected: Optional[tuple] = None,
+    ) -> bool:
+        # Runs without the lock, the reserved range belongs to this call alone
+        number, offset, fd = reserved
+        position = offset
+        try:
+            for chunk in chunks:
+                chunk = memoryview(chunk)
+                while chunk:
+                    written = os.pwrite(fd, chunk, position)
+                    position += written
+                    chunk = chunk[written:]
+        except BaseException:
+            # The record stays as dead bytes, its crc won't match on recovery
+            self._finish(blob_id, number, offset, length, False)
+            raise
+        return self._finish(blob_id, number, offset, length, True, expected)
+
+    def _drop(self, blob_id: str):
+        # Caller holds the lock, the bytes stay until their segment is compacted
+        location = self._index.pop(blob_id, None)
+        if location is not None:
+            self._segments[location[0]]["dead"] += RECORD.size + location[2]
+
+    def _view(self, blob_id: str) -> memoryview:
+        with self._lock:
+            location = self._index.get(blob_id)
+            if location is None:
+                raise FileNotFoundError(f"Blob {blob_id} is not stored")
+            number, offset, length = location
+            mapped = self._maps.get(number)
+            # The active segment keeps growing, map it again once a read
+            # reaches past the old mapping. Old maps stay valid for readers
+            # still holding views on them.
+            if mapped is None or len(mapped) < offset + length:
+                with open(self._segment_path(number), "rb") as f:
+                    mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self._maps[number] = mapped
+        return memoryview(mapped)[offset : offset + length]
+
+    def _prepare(self, tmp_path: str) -> dict:
+        path, codec, codec_seconds = self._encode(tmp_path)
+        # Encoded files carry their header already, raw ones get it on copy
+        prefix = compression.header(codec) if codec == "none" else b""
+        length, crc = file_crc(path, self.chunk_size, prefix)
+        return {
+            "path": path,
+            "prefix": prefix,
+            "codec": codec,
+            "seconds": codec_seconds,
+            "length": length,
+            "crc": crc,
+        }
+
+    def _commit(self, tmp_path: str, blob_id: str) -> dict:
+        prepared = None
+        with self._lock:
+            known = blob_id in self._index
+        if not known:
+            prepared = self._prepare(tmp_path)
+            tmp_path = prepared["path"]
+
+        with self._lock:
+            self._refs[blob_id] = self._refs.get(blob_id, 0) + 1
+            deduplicated = blob_id in self._index
+        if not deduplicated:
+            if prepared is None:
+                # Dropped since the check above, rare enough to encode now
+                prepared = self._prepare(tmp_path)
+                tmp_path = prepared["path"]
+            length = prepared["length"]
+            with self._lock:
+                reserved = self._reserve(blob_id, length, prepared["crc"])
+            self._seal_ready()
+            # Reads and other uploads carry on while this one is copied in
+            with open(tmp_path, "rb") as src:
+                chunks = itertools.chain(
+                    [prepared["prefix"]], iter(lambda: src.read(self.chunk_size), b"")
+                )
+                self._copy(blob_id, reserved, length, chunks)
+        os.unlink(tmp_path)
+
+        if deduplicated:
+            info = self.describe(blob_id)
+        else:
+            info = {"codec": prepared["codec"], "stored_size": prepared["length"]}
+        info["deduplicated"] = deduplicated
+        info["codec_ms"] = round(prepared["seconds"] * 1000 if prepared else 0, 3)
+        return info
+
+    def file_path(self, blob_id: str) -> Optional[str]:
+        # Blobs share segment files, they're always streamed from the mapping
+        return None
+
+    def _payload(self, blob_id: str) -> Tuple[str, memoryview]:
+        # Codec from the record's header and the stored bytes after it
+        view = self._view(blob_id)
+        codec = compression.codec_from_header(bytes(view[: compression.HEADER_SIZE]))
+        return codec, view[compression.HEADER_SIZE :]
+
+    def describe(self, blob_id: str) -> dict:
+        codec, view = self._payload(blob_id)
+        return {"codec": codec, "stored_size": compression.HEADER_SIZE + len(view)}
+
+    def codec_of(self, blob_id: str) -> str:
+        return self.describe(blob_id)["codec"]
+
+    def iter_range(self, blob_id: str, start: int, end: int):
+        codec, view = self._payload(blob_id)
+        if codec == "none":
+            # Slices of the mapping go to the socket without a copy
+            end = min(end, len(view) - 1)
+            for position in range(start, end + 1, self.chunk_size):
+                yield view[position : min(position + self.chunk_size, end + 1)]
+            return
+        yield from self._decoded_range(ViewReader(view), codec, start, end)
+
+    def read(self, blob_id: str):
+        codec, view = self._payload(blob_id)
+        if codec == "none":
+            return view
+        return b"".join(self._decoded_chunks(ViewReader(view), codec))
+
+    def load_refs(self, counts: Dict[str, int]):
+        # Anything in the segments that no document points at is garbage
+        with self._lock:
+            self._refs = dict(counts)
+            for blob_id in [b for b in self._index if b not in self._refs]:
+                self._drop(blob_id)
+
+    def release(self, blob_id: str):
+        with self._lock:
+            count = self._refs.get(blob_id, 0) - 1
+            if count > 0:
+                self._refs[blob_id] = count
+                return
+            self._refs.pop(blob_id, None)
+            self._drop(blob_id)
+
+    def _compact_segment(self, number: int) -> int:
+        with self._lock:
+            live = [
+                (blob_id, location)
+                for blob_id, location in self._index.items()
+                if location[0] == number
+            ]
+        # Live records are copied to the active segment like uploads, and
+        # only published if the blob wasn't dropped while being copied
+        copied = 0
+        targets = set()
+        for blob_id, location in live:
+            view = self._view(blob_id)
+            crc = zlib.crc32(view)
+            with self._lock:
+                if self._index.get(blob_id) != location:
+                    continue
+                reserved = self._reserve(blob_id, len(view), crc)
+            self._seal_ready()
+            chunks = (
+                view[i : i + self.chunk_size]
+                for i in range(0, len(view), self.chunk_size)
+            )
+            if self._copy(blob_id, reserved, len(view), chunks, location):
+                copied += RECORD.size + len(view)
+                targets.add(reserved[0])
+            del view
+
+        # The copies have to be on disk before the only other one goes
+        for target in targets:
+            fd = os.open(self._segment_path(target), os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+        with self._lock:
+            size = self._segments.pop(number)["size"]
+            self._maps.pop(number, None)
+            os.unlink(self._segment_path(number))
+        return size - copied
+
+    def compact(self) -> int:
+        """Rewrite sealed segments that are mostly dead, returns bytes reclaimed."""
+        with self._lock:
+            candidates = [
+                number
+                for number, info in self._segments.items()
+                if number not in self._writing
+                and info["dead"] >= SEGMENT_COMPACT_RATIO * info["size"]
+            ]
+        reclaimed = 0
+        for number in candidates:
+            reclaimed += self._compact_segment(number)
+            self.compactions += 1
+        self.reclaimed_bytes += reclaimed
+        return reclaimed
+
+    async def _maintain(self):
+        while True:
+            await asyncio.sleep(SEGMENT_COMPACT_INTERVAL)
+            await asyncio.to_thread(self.compact)
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._maintain())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        with self._lock:
+            # Left unsealed, the next start walks its records and keeps appending
+            for writing in self._writing.values():
+                os.fsync(writing["fd"])
+
+    def stats(self) -> dict:
+        stats = super().stats()
+        with self._lock:
+            stats.update(
+                segments=len(self._segments),
+                segment_bytes=sum(i["size"] for i in self._segments.values()),
+                dead_bytes=sum(i["dead"] for i in self._segments.values()),
+                compactions=self.compactions,
+                reclaimed_bytes=self.reclaimed_bytes,
+            )
+        return stats
@@ -0,0 +1,275 @@
+import hashlib
+import os
+import threading
+import time
+import uuid
+from typing import Dict, Optional, Tuple
+
+from starlette.concurrency import run_in_threadpool
+
+import compression
+
+# Uploaded PDFs are kept on disk, only a small metadata record stays in memory.
+# Blobs are named by the sha256 of their content so identical uploads share one
+# file, per-user records just hold a reference to it. Blobs that compress well
+# are stored through a codec (see compression.py) and decoded on read, their
+# file name ends in the codec so reads know how to decode without sniffing.
+BLOB_DIR = os.getenv(
+    "BLOB_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "blobs")
+)
+CHUNK_SIZE = 1024 * 1024  # 1 MiB per read from the upload
+# "files" keeps one file per blob, "segments" packs them into segment files
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "files")
+
+
+class BlobStore:
+    def __init__(
+        self,
+        root: str = BLOB_DIR,
+        chunk_size: int = CHUNK_SIZE,
+        codec: str = compression.STORAGE_CODEC,
+        level: int = compression.STORAGE_CODEC_LEVEL,
+    ):
+        self.root = root
+        self.chunk_size = chunk_size
+        self.codec = codec
+        self.level = level
+        self.tmp_dir = os.path.join(root, "tmp")
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        self._refs: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self.open_uploads = 0
+        self.deduplicated_uploads = 0
+
+    def _path(self, blob_id: str, codec: str = "none") -> str:
+        # Fan out into sub directories so no single directory gets huge
+        name = blob_id if codec == "none" else f"{blob_id}.{codec}"
+        return os.path.join(self.root, blob_id[:2], name)
+
+    def _locate(self, blob_id: str) -> Optional[Tuple[str, str]]:
+        """Path and codec of a stored blob, None if it isn't stored."""
+        for codec in compression.CODEC_IDS:
+            path = self._path(blob_id, codec)
+            if os.path.exists(path):
+                return path, codec
+        return None
+
+    def _open(self, blob_id: str):
+        # Positioned at the payload, past the header of compressed blobs
+        located = self._locate(blob_id)
+        if located is None:
+            raise FileNotFoundError(f"Blob {blob_id} is not stored")
+        path, codec = located
+        f = open(path, "rb")
+        if codec != "none":
+            f.seek(compression.HEADER_SIZE)
+        return f, codec
+
+    def file_path(self, blob_id: str) -> Optional[str]:
+        """File holding just this blob, so raw ones can go to FileResponse."""
+        located = self._locate(blob_id)
+        if located is None or located[1] != "none":
+            return None
+        return located[0]
+
+    @staticmethod
+    def _write_chunk(out, digest, chunk: bytes):
+        # Runs in the threadpool, hashlib releases the GIL for large buffers
+        digest.update(chunk)
+        out.write(chunk)
+
+    def _encode(self, tmp_path: str) -> Tuple[str, str, float]:
+        # Returns the file to store, its codec and the seconds spent encoding
+        start = time.perf_counter()
+        with open(tmp_path, "rb") as src:
+            codec = compression.choose_codec(
+                src.read(compression.SAMPLE_SIZE), self.codec, self.level
+            )
+        if codec is None:
+            return tmp_path, "none", time.perf_counter() - start
+
+        encoded_path = tmp_path + "." + codec
+        engine = compression.compressor(codec, self.level)
+        with open(tmp_path, "rb") as src, open(encoded_path, "wb") as out:
+            out.write(compression.header(codec))
+            while True:
+                chunk = src.read(self.chunk_size)
+                if not chunk:
+                    break
+                out.write(engine.compress(chunk))
+            out.write(engine.flush())
+        elapsed = time.perf_counter() - start
+
+        if os.path.getsize(encoded_path) >= os.path.getsize(tmp_path):
+            os.unlink(encoded_path)
+            return tmp_path, "none", elapsed
+        os.unlink(tmp_path)
+        return encoded_path, codec, elapsed
+
+    def describe(self, blob_id: str) -> dict:
+        located = self._locate(blob_id)
+        if located is None:
+            raise FileNotFoundError(f"Blob {blob_id} is not stored")
+        path, codec = located
+        return {"codec": codec, "stored_size": os.path.getsize(path)}
+
+    def _commit(self, tmp_path: str, blob_id: str) -> dict:
+        codec, codec_seconds = "none", 0.0
+        # Known content skips the encoder entirely
+        if self._locate(blob_id) is None:
+            tmp_path, codec, codec_seconds = self._encode(tmp_path)
+
+        with self._lock:
+            self._refs[blob_id] = self._refs.get(blob_id, 0) + 1
+            deduplicated = self._locate(blob_id) is not None
+            if deduplicated:
+                os.unlink(tmp_path)
+            else:
+                final_path = self._path(blob_id, codec)
+                os.makedirs(os.path.dirname(final_path), exist_ok=True)
+                os.replace(tmp_path, final_path)
+            info = self.describe(blob_id)
+
+        info["deduplicated"] = deduplicated
+        info["codec_ms"] = round(codec_seconds * 1000, 3)
+        return info
+
+    async def save_upload(self, upload) -> dict:
+        """Stream an UploadFile to disk chunk by chunk and return its metadata."""
+        tmp_path = os.path.join(self.tmp_dir, uuid.uuid4().hex)
+        digest = hashlib.sha256()
+        size = 0
+
+        self.open_uploads += 1
+        out = await run_in_threadpool(open, tmp_path, "wb")
+        try:
+            while True:
+                chunk = await upload.read(self.chunk_size)
+                if not chunk:
+                    break
+                size += len(chunk)
+                await run_in_threadpool(self._write_chunk, out, digest, chunk)
+            await run_in_threadpool(out.close)
+            blob_id = digest.hexdigest()
+            info = await run_in_threadpool(self._commit, tmp_path, blob_id)
+        except BaseException:
+            out.close()
+            for path in (tmp_path, tmp_path + ".zlib", tmp_path + ".lzma"):
+                if os.path.exists(path):
+                    os.unlink(path)
+            raise
+        finally:
+            self.open_uploads -= 1
+
+        if info["deduplicated"]:
+            self.deduplicated_uploads += 1
+        info.update(blob_id=blob_id, size=size, sha256=blob_id)
+        return info
+
+    def _decoded_chunks(self, f, codec: str):
+        # Output is capped per step so highly compressible blobs can't balloon
+        engine = compression.decompressor(codec)
+        if codec == "zlib":
+            pending = b""
+            while True:
+                if not pending:
+                    pending = f.read(self.chunk_size)
+                    if not pending:
+                        tail = engine.flush()
+                        if tail:
+                            yield tail
+                        return
+                data = engine.decompress(pending, self.chunk_size)
+                pending = engine.unconsumed_tail
+                if data:
+                    yield data
+        else:
+            while not engine.eof:
+                raw = b""
+                if engine.needs_input:
+                    raw = f.read(self.chunk_size)
+                    if not raw:
+                        return
+                data = engine.decompress(raw, self.chunk_size)
+                if data:
+                    yield data
+
+    def codec_of(self, blob_id: str) -> str:
+        return self.describe(blob_id)["codec"]
+
+    def iter_range(self, blob_id: str, start: int, end: int):
+        # Sync generator, StreamingResponse runs it in the threadpool
+        remaining = end - start + 1
+        f, codec = self._open(blob_id)
+        with f:
+            if codec == "none":
+                f.seek(start)
+                while remaining > 0:
+                    chunk = f.read(min(self.chunk_size, remaining))
+                    if not chunk:
+                        break
+                    remaining -= len(chunk)
+                    yield chunk
+                return
+
+            yield from self._decoded_range(f, codec, start, end)
+
+    def _decoded_range(self, f, codec: str, start: int, end: int):
+        # Compressed blobs can't seek, decode and drop bytes before start
+        remaining = end - start + 1
+        skip = start
+        for chunk in self._decoded_chunks(f, codec):
+            if skip >= len(chunk):
+                skip -= len(chunk)
+                continue
+            chunk = chunk[skip : skip + remaining]
+            skip = 0
+            remaining -= len(chunk)
+            yield chunk
+            if remaining <= 0:
+                break
+
+    def read(self, blob_id: str) -> bytes:
+        f, codec = self._open(blob_id)
+        with f:
+            if codec == "none":
+                return f.read()
+            return b"".join(self._decoded_chunks(f, codec))
+
+    def load_refs(self, counts: Dict[str, int]):
+        # Counts come from the documents table so they survive restarts
+        with self._lock:
+            self._refs = dict(counts)
+
+    def add_ref(self, blob_id: str):
+        with self._lock:
+            self._refs[blob_id] = self._refs.get(blob_id, 0) + 1
+
+    def release(self, blob_id: str):
+        # Drop one reference, the file goes once nothing points at it
+        with self._lock:
+            count = self._refs.get(blob_id, 0) - 1
+            if count > 0:
+                self._refs[blob_id] = count
+                return
+            self._refs.pop(blob_id, None)
+            located = self._locate(blob_id)
+            if located is not None:
+                os.unlink(located[0])
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def stats(self) -> dict:
+        with self._lock:
+            blobs = len(self._refs)
+            references = sum(self._refs.values())
+        return {
+            "blobs": blobs,
+            "references": references,
+            "open_uploads": self.open_uploads,
+            "deduplicated_uploads": self.deduplicated_uploads,
+        }
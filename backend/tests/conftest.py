@@ -0,0 +1,71 @@
+import asyncio
+import datetime
+import os
+import sys
+import tempfile
+
+import pytest
+
+# The backend modules import each other by bare name, and database.py reads
+# DATABASE_URL at import time, so both are set up before anything is imported
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+TEST_DIR = tempfile.mkdtemp(prefix="rolsa-tests-")
+os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(TEST_DIR, "test.db")
+os.environ["BLOB_DIR"] = os.path.join(TEST_DIR, "blobs")
+
+import database  # noqa: E402
+import models  # noqa: E402
+
+
+@pytest.fixture
+def db():
+    models.Base.metadata.create_all(bind=database.engine)
+    with database.SessionLocal() as session:
+        yield session
+    models.Base.metadata.drop_all(bind=database.engine)
+
+
+def run(coro):
+    """Run a coroutine on a fresh loop, pooled aiosqlite connections can't
+    outlive the loop they were opened on."""
+
+    async def main():
+        try:
+            return await coro
+        finally:
+            await database.async_engine.dispose()
+
+    return asyncio.run(main())
+
+
+def make_user(db, email: str, user_type: str = "customer") -> models.User:
+    user = models.User(
+        email=email,
+        password_hash="x",
+        first_name="Test",
+        last_name="User",
+        user_type=user_type,
+    )
+    db.add(user)
+    db.commit()
+    return user
+
+
+def make_property(db, user: models.User, **values) -> models.Property:
+    values = {
+        "address_line1": "1 Test Road",
+        "city": "Town",
+        "postcode": "AB1 2CD",
+        "property_type": "Detached",
+        "roof_size": 0,
+        **values,
+    }
+    prop = models.Property(user_id=user.user_id, **values)
+    db.add(prop)
+    db.commit()
+    return prop
+
+
+def month_start(day: datetime.date) -> datetime.date:
+    return day.replace(day=1)
@@ -0,0 +1,150 @@
+import asyncio
+import threading
+
+import pytest
+from sqlalchemy import select
+
+import audit
+import models
+from conftest import make_property, make_user, run
+from database import AsyncSessionLocal
+
+
+@pytest.fixture(params=["async", "sync"])
+def durability(request, monkeypatch):
+    monkeypatch.setattr(audit, "AUDIT_DURABILITY", request.param)
+    return request.param
+
+
+@pytest.fixture
+def admin(db):
+    user = make_user(db, "admin@example.com", "admin")
+    token = audit.current_admin.set(user.user_id)
+    yield user
+    audit.current_admin.reset(token)
+
+
+def changes(db, table=None):
+    audit.writer.flush()
+    query = select(models.AdminChange).order_by(models.AdminChange.change_id)
+    if table is not None:
+        query = query.where(models.AdminChange.table_affected == table)
+    db.expire_all()
+    return db.scalars(query).all()
+
+
+def test_create_update_delete(db, admin, durability):
+    user = make_user(db, "someone@example.com")
+    user.phone = "0123"
+    db.commit()
+    db.delete(user)
+    db.commit()
+
+    created, updated, deleted = changes(db, "users")
+    assert created.change_type == "create" and created.admin_id == admin.user_id
+    assert created.new_value["email"] == "someone@example.com"
+    assert updated.record_id == user.user_id
+    assert updated.old_value == {"phone": None}
+    assert updated.new_value == {"phone": "0123"}
+    assert deleted.change_type == "delete" and deleted.new_value is None
+
+
+def test_password_hash_is_never_recorded(db, admin, durability):
+    user = make_user(db, "someone@example.com")
+    user.password_hash = "secret"
+    user.first_name = "Renamed"
+    db.commit()
+
+    for change in changes(db, "users"):
+        for values in (change.old_value, change.new_value):
+            assert "password_hash" not in (values or {})
+    assert changes(db, "users")[-1].new_value == {"first_name": "Renamed"}
+
+
+def test_old_value_of_an_expired_attribute_is_read(db, admin, durability):
+    user = make_user(db, "someone@example.com")
+    # The commit expired everything, the old value was never loaded
+    assert "last_name" not in user.__dict__
+    user.last_name = "Changed"
+    db.commit()
+
+    update = changes(db, "users")[-1]
+    assert update.old_value == {"last_name": "User"}
+    assert update.new_value == {"last_name": "Changed"}
+
+
+def test_rolled_back_changes_are_not_recorded(db, admin, durability):
+    db.add(
+        models.User(
+            email="gone@example.com",
+            password_hash="x",
+            first_name="A",
+            last_name="B",
+            user_type="customer",
+        )
+    )
+    db.flush()
+    db.rollback()
+    assert changes(db, "users") == []
+
+
+def test_unset_admin_records_nothing(db, durability):
+    make_user(db, "someone@example.com")
+    assert changes(db) == []
+
+
+def test_core_inserts_are_recorded_with_their_ids(db, admin, durability):
+    prop = make_property(db, admin)
+    base = {"user_id": admin.user_id, "property_id": prop.property_id}
+    rows = [{**base, "energy_consumption": value} for value in (100, 200)]
+    audit.insert_rows(db, models.EnergyCalculation, rows)
+    db.commit()
+
+    ids = db.scalars(select(models.EnergyCalculation.calculation_id)).all()
+    recorded = changes(db, "energy_calculation")
+    assert sorted(change.record_id for change in recorded) == sorted(ids)
+    assert {change.new_value["energy_consumption"] for change in recorded} == {
+        100,
+        200,
+    }
+
+
+def test_async_session_commits_are_recorded(db, admin, durability):
+    async def scenario():
+        async with AsyncSessionLocal() as session:
+            session.add(
+                models.User(
+                    email="async@example.com",
+                    password_hash="x",
+                    first_name="A",
+                    last_name="B",
+                    user_type="customer",
+                )
+            )
+            await session.commit()
+
+    run(scenario())
+    (created,) = changes(db, "users")
+    assert created.new_value["email"] == "async@example.com"
+
+
+def test_overflow_on_the_event_loop_is_written_off_it(db, monkeypatch):
+    writer = audit.AuditWriter(max_queued=1)
+    threads = []
+    monkeypatch.setattr(
+        writer, "_write", lambda rows: threads.append(threading.current_thread())
+    )
+    # Keep the writer thread from taking the queued row
+    monkeypatch.setattr(writer, "start", lambda: None)
+
+    async def submit():
+        writer.submit([{}, {}])
+
+    asyncio.run(submit())
+    writer.flush()
+    assert writer.overflow == 1
+    assert threads and threads[0] is not threading.main_thread()
+
+    writer.submit([{}])
+    assert threads[-1] is threading.main_thread()
+    writer.stop()
@@ -0,0 +1,58 @@
+import datetime
+
+import models
+import repository
+from conftest import make_user, run
+from database import AsyncSessionLocal
+
+NOON = datetime.datetime(2026, 3, 14, 12)
+
+
+def add_documents(db, user, filenames):
+    for i, filename in enumerate(filenames):
+        db.add(
+            models.Document(
+                user_id=user.user_id,
+                pdf_id=f"doc-{i}",
+                filename=filename,
+                sha256="0" * 64,
+                size=1,
+                # Every document shares its created_at, pdf_id orders them
+                created_at=NOON,
+            )
+        )
+    db.commit()
+
+
+def list_all(username, **options):
+    async def scenario():
+        pages, cursor = [], None
+        async with AsyncSessionLocal() as session:
+            while True:
+                page, cursor = await repository.list_documents(
+                    session, username, 2, cursor=cursor, **options
+                )
+                pages.extend(row["filename"] for row in page)
+                if cursor is None:
+                    return pages
+
+    return run(scenario())
+
+
+def test_pages_walk_ties_in_pdf_id_order(db):
+    user = make_user(db, "owner@example.com")
+    names = [f"{i}.pdf" for i in range(5)]
+    add_documents(db, user, names)
+    assert list_all(user.email) == names
+    assert list_all(user.email, descending=True) == names[::-1]
+
+
+def test_prefix_is_matched_literally(db):
+    user = make_user(db, "owner@example.com")
+    add_documents(
+        db, user, ["r_1.pdf", "rx.pdf", "r%.pdf", "r/2.pdf", "s.pdf", "r\U0010ffff"]
+    )
+    assert list_all(user.email, sort="filename", prefix="r_") == ["r_1.pdf"]
+    assert list_all(user.email, sort="filename", prefix="r%") == ["r%.pdf"]
+    assert list_all(user.email, sort="filename", prefix="r/") == ["r/2.pdf"]
+    assert len(list_all(user.email, sort="filename", prefix="r")) == 5
@@ -0,0 +1,99 @@
+import legal
+import repository
+from conftest import make_user, run
+from database import AsyncSessionLocal
+from legal import LegalVersions, apply_delta, make_delta
+
+BASE = "".join(f"Clause {i}: the customer agrees to term {i}.\n" for i in range(40))
+
+
+def revisions() -> list:
+    lines = BASE.splitlines(keepends=True)
+    texts = [BASE]
+    for i in range(12):
+        lines = list(lines)
+        lines[i * 3] = f"Clause {i * 3}: amended in revision {i}.\n"
+        if i % 4 == 0:
+            lines.insert(0, f"Preamble {i}\n")
+        if i % 5 == 0:
+            del lines[-1]
+        texts.append("".join(lines))
+    return texts
+
+
+def test_delta_round_trips():
+    for base, text in (
+        (BASE, BASE.replace("term 7", "term seven")),
+        (BASE, "New first line\n" + BASE),
+        (BASE, BASE + "no trailing newline"),
+        (BASE, ""),
+        ("", BASE),
+    ):
+        assert apply_delta(base, make_delta(base, text)) == text
+
+
+def test_encode_takes_a_snapshot_every_n_versions():
+    versions = LegalVersions(snapshot_every=3)
+    assert versions.encode(None, 0, BASE) is None
+    assert versions.encode(BASE, 0, BASE + "x\n") is not None
+    assert versions.encode(BASE, 1, BASE + "y\n") is not None
+    assert versions.encode(BASE, 2, BASE + "z\n") is None
+    # A rewrite is stored whole, its delta is no smaller than the text
+    assert versions.encode(BASE, 0, BASE.upper()) is None
+
+
+async def store_version(session, versions: LegalVersions, admin_id: int, text: str):
+    # The same steps as POST /legal
+    async def fetch(document_id):
+        return await repository.legal_content(session, document_id)
+
+    previous = await repository.last_legal_version(session, "Terms", "legal")
+    base_id, base, deltas_since = None, None, 0
+    if previous is not None:
+        if previous.delta is None:
+            base_id, base = previous.document_id, previous.content
+        else:
+            base_id = previous.base_document_id
+            base = await versions.snapshot(base_id, fetch)
+        deltas_since = await repository.legal_deltas_since(session, base_id)
+    delta = versions.encode(base, deltas_since, text)
+    record = await repository.add_legal_document(
+        session,
+        document_type="legal",
+        title="Terms",
+        version=str(len(text)),
+        created_by=admin_id,
+        content=None if delta else text,
+        base_document_id=base_id if delta else None,
+        delta=delta,
+    )
+    return record.document_id
+
+
+def test_every_version_is_rebuilt_from_the_database(db, monkeypatch):
+    monkeypatch.setattr(legal, "LEGAL_SNAPSHOT_RATIO", 0.9)
+    admin = make_user(db, "admin@example.com", "admin")
+    texts = revisions()
+
+    async def scenario():
+        writer = LegalVersions(snapshot_every=5)
+        async with AsyncSessionLocal() as session:
+            ids = [
+                await store_version(session, writer, admin.user_id, t) for t in texts
+            ]
+        # A fresh worker with nothing cached reads them back
+        reader = LegalVersions()
+        rebuilt = []
+        async with AsyncSessionLocal() as session:
+            for document_id in ids:
+                document = await repository.get_legal_document(session, document_id)
+                rebuilt.append(
+                    await reader.content(
+                        document, lambda i: repository.legal_content(session, i)
+                    )
+                )
+        return writer, rebuilt
+
+    writer, rebuilt = run(scenario())
+    assert rebuilt == texts
+    assert writer.deltas > 0 and writer.snapshots == 3
@@ -0,0 +1,68 @@
+import asyncio
+import gzip
+
+import responses
+from responses import CompressionMiddleware, etag_matches
+
+BODY = b'{"content": "' + b"x" * 4096 + b'"}'
+HEADERS = [
+    (b"content-type", b"application/json"),
+    (b"etag", b'W/"abc"'),
+    (b"cache-control", b"private, immutable"),
+    (b"vary", b"Accept-Encoding"),
+]
+
+
+async def app(scope, receive, send):
+    await send({"type": "http.response.start", "status": 200, "headers": HEADERS})
+    # Lets a second request reach the cache while the first compresses
+    await asyncio.sleep(0)
+    await send({"type": "http.response.body", "body": BODY})
+
+
+async def call(middleware) -> list:
+    scope = {
+        "type": "http",
+        "path": "/pdf/1",
+        "headers": [(b"accept-encoding", b"gzip")],
+    }
+    sent = []
+
+    async def send(message):
+        sent.append(message)
+
+    await middleware(scope, None, send)
+    return sent
+
+
+def test_etag_matches_compares_weakly():
+    assert etag_matches('"abc"', 'W/"abc"')
+    assert etag_matches('W/"x", W/"abc"', 'W/"abc"')
+    assert etag_matches("*", '"abc"')
+    assert not etag_matches('"abd"', 'W/"abc"')
+    assert not etag_matches(None, '"abc"')
+
+
+def test_concurrent_misses_compress_once(monkeypatch):
+    calls = []
+    original = responses.compress
+
+    def counting(data, encoding):
+        calls.append(encoding)
+        return original(data, encoding)
+
+    monkeypatch.setattr(responses, "compress", counting)
+    middleware = CompressionMiddleware(app, minimum_size=1)
+
+    async def scenario():
+        return await asyncio.gather(*(call(middleware) for _ in range(3)))
+
+    results = asyncio.run(scenario())
+    assert calls == ["gzip"]
+    for start, body in results:
+        headers = dict(start["headers"])
+        assert headers[b"content-encoding"] == b"gzip"
+        assert headers[b"vary"] == b"Accept-Encoding"
+        assert gzip.decompress(body["body"]) == BODY
+    assert middleware.cache.stats()["entries"] == 1
+    assert middleware._building == {}
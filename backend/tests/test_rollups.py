@@ -0,0 +1,105 @@
+import datetime
+
+from sqlalchemy import func, select
+
+import calculations
+import models
+import rollups
+from conftest import make_property, make_user, month_start
+
+
+def rollup(db, scope: str, scope_id: int, period: str, start: datetime.date):
+    return db.get(models.CalculationRollup, (scope, scope_id, period, start))
+
+
+def test_flush_hook_adds_and_removes_rows(db):
+    user = make_user(db, "owner@example.com")
+    prop = make_property(db, user)
+    when = datetime.datetime(2026, 3, 14, 12)
+    row = models.EnergyCalculation(
+        user_id=user.user_id,
+        property_id=prop.property_id,
+        energy_consumption=1500,
+        date=when,
+    )
+    db.add(row)
+    db.commit()
+
+    day = rollup(db, "property", prop.property_id, "day", when.date())
+    month = rollup(db, "user", user.user_id, "month", month_start(when.date()))
+    assert float(day.energy_consumption) == 1500 and day.energy_count == 1
+    assert float(month.energy_consumption) == 1500 and month.energy_count == 1
+
+    db.delete(row)
+    db.commit()
+    db.refresh(month)
+    assert float(month.energy_consumption) == 0 and month.energy_count == 0
+
+
+def test_batch_run_twice_replaces_the_month(db):
+    user = make_user(db, "owner@example.com")
+    prop = make_property(db, user, property_type="Detached", roof_size=0)
+    factors = calculations.load_factors(None)
+
+    calculations.run_batch(db, factors)
+    factors["emission_factor"] = 0.1
+    summary = calculations.run_batch(db, factors)
+    assert summary["replaced"] == 1
+
+    today = datetime.datetime.utcnow().date()
+    for scope, scope_id in (("property", prop.property_id), ("user", user.user_id)):
+        month = rollup(db, scope, scope_id, "month", month_start(today))
+        assert float(month.energy_consumption) == 4300
+        assert month.energy_count == 1
+        assert float(month.carbon_released) == 430
+        assert month.carbon_count == 1
+    for model in (models.EnergyCalculation, models.CarbonFootprint):
+        assert db.scalar(select(func.count()).select_from(model)) == 1
+
+
+def test_batch_run_keeps_earlier_months(db):
+    user = make_user(db, "owner@example.com")
+    prop = make_property(db, user)
+    earlier = datetime.datetime.utcnow().replace(day=1) - datetime.timedelta(days=1)
+    db.add(
+        models.EnergyCalculation(
+            user_id=user.user_id,
+            property_id=prop.property_id,
+            energy_consumption=1000,
+            date=earlier,
+        )
+    )
+    db.commit()
+
+    summary = calculations.run_batch(db, calculations.load_factors(None))
+    assert summary["replaced"] == 0
+    old = rollup(db, "property", prop.property_id, "month", month_start(earlier.date()))
+    assert float(old.energy_consumption) == 1000 and old.energy_count == 1
+    count = db.scalar(select(func.count()).select_from(models.EnergyCalculation))
+    assert count == 2
+
+
+def test_rebuild_matches_incremental_rollups(db):
+    user = make_user(db, "owner@example.com")
+    for roof_size in (0, 10, 20):
+        make_property(db, user, roof_profile="Sloped", roof_size=roof_size)
+    factors = calculations.load_factors(None)
+    calculations.run_batch(db, factors)
+    calculations.run_batch(db, factors)
+
+    def snapshot():
+        rows = db.scalars(select(models.CalculationRollup)).all()
+        return {
+            (r.scope, r.scope_id, r.period, r.period_start): (
+                float(r.energy_consumption),
+                r.energy_count,
+                float(r.carbon_released),
+                r.carbon_count,
+            )
+            for r in rows
+            if r.energy_count or r.carbon_count
+        }
+
+    incremental = snapshot()
+    rollups.rebuild(db)
+    assert snapshot() == incremental
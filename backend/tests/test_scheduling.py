@@ -0,0 +1,118 @@
+import datetime
+
+import pytest
+from sqlalchemy.exc import IntegrityError
+
+import repository
+import scheduling
+from conftest import make_property, make_user, run
+from database import AsyncSessionLocal
+
+# A Monday well in the future, working hours start at 09:00
+MONDAY = datetime.datetime(2030, 1, 7, 9)
+HOUR = datetime.timedelta(hours=1)
+
+
+def test_reserve_rejects_a_taken_slot():
+    schedule = scheduling.Schedule()
+    schedule.load([1, 2], [(1, MONDAY)])
+    with pytest.raises(scheduling.SlotUnavailable):
+        schedule.reserve(1, MONDAY)
+    schedule.reserve(2, MONDAY)
+    assert schedule.free_consultants(MONDAY) == []
+
+
+def test_unaligned_bookings_block_overlapping_slots():
+    schedule = scheduling.Schedule()
+    schedule.load([1], [(1, MONDAY + datetime.timedelta(minutes=30))])
+    free = schedule.next_free(MONDAY, MONDAY + 4 * HOUR, 10)
+    assert [slot for slot, _ in free] == [MONDAY + 2 * HOUR, MONDAY + 3 * HOUR]
+
+
+def test_next_free_merges_consultants_in_time_order():
+    schedule = scheduling.Schedule()
+    schedule.load([1, 2], [(1, MONDAY), (2, MONDAY + HOUR)])
+    free = schedule.next_free(MONDAY, MONDAY + 3 * HOUR, 4)
+    assert free == [
+        (MONDAY, 2),
+        (MONDAY + HOUR, 1),
+        (MONDAY + 2 * HOUR, 1),
+        (MONDAY + 2 * HOUR, 2),
+    ]
+
+
+def test_unknown_consultant_is_rejected():
+    schedule = scheduling.Schedule()
+    schedule.load([1], [])
+    with pytest.raises(ValueError):
+        schedule.next_free(MONDAY, MONDAY + HOUR, 1, [7])
+    with pytest.raises(ValueError):
+        schedule.reserve(7, MONDAY)
+
+
+def test_reload_keeps_claims_the_database_has_not_shown_yet():
+    schedule = scheduling.Schedule()
+    schedule.load([1], [])
+    schedule.reserve(1, MONDAY)
+    # Reloaded before the booking committed, the claim still holds
+    schedule.load([1, 2], [])
+    assert schedule.free_consultants(MONDAY) == [2]
+    # Once the database has it the claim is dropped, a cancel then frees it
+    schedule.load([1, 2], [(1, MONDAY)])
+    schedule.load([1, 2], [])
+    assert schedule.free_consultants(MONDAY) == [1, 2]
+
+
+def test_release_drops_the_claim():
+    schedule = scheduling.Schedule()
+    schedule.load([1], [])
+    schedule.reserve(1, MONDAY)
+    schedule.release(1, MONDAY)
+    schedule.load([1], [])
+    assert schedule.free_consultants(MONDAY) == [1]
+
+
+def test_refresh_picks_up_new_consultants():
+    schedule = scheduling.Schedule()
+    schedule.load([1], [])
+    state = ([1, 2], [(2, MONDAY)])
+
+    async def fetch():
+        return state
+
+    run(schedule.refresh(fetch))
+    assert schedule.has_consultant(2)
+    assert schedule.free_consultants(MONDAY) == [1]
+
+
+def test_database_refuses_a_second_booking_until_cancelled(db):
+    owner = make_user(db, "owner@example.com")
+    consultant = make_user(db, "fixer@example.com", "serviceman")
+    prop = make_property(db, owner)
+
+    async def scenario():
+        async with AsyncSessionLocal() as session:
+            first = await repository.add_consultation(
+                session, prop.property_id, consultant.user_id, MONDAY
+            )
+        async with AsyncSessionLocal() as session:
+            with pytest.raises(IntegrityError):
+                await repository.add_consultation(
+                    session, prop.property_id, consultant.user_id, MONDAY
+                )
+        async with AsyncSessionLocal() as session:
+            assert await repository.cancel_consultation(
+                session, first.consultation_id
+            )
+            assert not await repository.cancel_consultation(
+                session, first.consultation_id
+            )
+        async with AsyncSessionLocal() as session:
+            await repository.add_consultation(
+                session, prop.property_id, consultant.user_id, MONDAY
+            )
+            since = MONDAY - HOUR
+            bookings = await repository.scheduled_consultations(session, since)
+        return bookings
+
+    assert run(scenario()) == [(consultant.user_id, MONDAY)]
@@ -0,0 +1,92 @@
+import datetime
+
+import models
+import repository
+from conftest import make_user, run
+from database import AsyncSessionLocal
+from tickets import TicketQueue
+
+NOON = datetime.datetime(2026, 3, 14, 12)
+MINUTE = datetime.timedelta(minutes=1)
+
+
+def drain(queue: TicketQueue) -> list:
+    ids = []
+    while True:
+        entry = queue.pop()
+        if entry is None:
+            return ids
+        ids.append(entry[2])
+
+
+def test_pop_orders_by_priority_then_age_then_id():
+    queue = TicketQueue()
+    queue.load(
+        [
+            (1, "low", NOON),
+            (2, "urgent", NOON + MINUTE),
+            (3, "high", NOON),
+            (4, "urgent", NOON),
+            (5, "urgent", NOON),
+        ]
+    )
+    assert drain(queue) == [4, 5, 2, 3, 1]
+
+
+def test_discarded_and_popped_tickets_are_not_handed_out_again():
+    queue = TicketQueue()
+    queue.load([(1, "high", NOON), (2, "medium", NOON)])
+    queue.discard(1)
+    entry = queue.pop()
+    assert entry[2] == 2
+    queue.push(1, "high", NOON)
+    queue.requeue(entry)
+    assert drain(queue) == [1, 2]
+
+
+def test_refresh_finds_lower_ids_committed_after_a_local_push():
+    queue = TicketQueue()
+    queue.load([(1, "medium", NOON)])
+    # This worker's own ticket, another worker's id 2 commits after it
+    queue.push(3, "medium", NOON + 2 * MINUTE)
+    committed = [(1, "medium", NOON), (2, "urgent", NOON + MINUTE)]
+    asked = []
+
+    async def fetch(since):
+        asked.append(since)
+        return [row for row in committed if since is None or row[2] >= since]
+
+    run(queue.refresh(fetch))
+    assert asked[0] <= NOON
+    assert drain(queue) == [2, 1, 3]
+
+
+def test_open_tickets_since(db):
+    user = make_user(db, "owner@example.com")
+    for status, created_at in (
+        ("open", NOON - MINUTE),
+        ("open", NOON),
+        ("in_progress", NOON),
+    ):
+        db.add(
+            models.CustomerTicket(
+                user_id=user.user_id,
+                category="Technical",
+                subject="Broken",
+                description="Panel",
+                status=status,
+                priority="medium",
+                created_at=created_at,
+            )
+        )
+    db.commit()
+
+    async def scenario():
+        async with AsyncSessionLocal() as session:
+            every = await repository.open_tickets(session)
+            recent = await repository.open_tickets(session, NOON)
+        return every, recent
+
+    every, recent = run(scenario())
+    assert [row[0] for row in every] == [1, 2]
+    assert recent == [(2, "medium", NOON)]
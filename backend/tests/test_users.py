@@ -0,0 +1,110 @@
+import datetime
+
+from sqlalchemy import func, select
+
+import models
+import repository
+from conftest import make_property, make_user, run
+from database import AsyncSessionLocal
+
+SLOT = datetime.datetime(2030, 1, 7, 9)
+
+
+def count(db, model) -> int:
+    return db.scalar(select(func.count()).select_from(model))
+
+
+def delete_user(db, user_id: int):
+    async def scenario():
+        async with AsyncSessionLocal() as session:
+            user = await session.get(models.User, user_id)
+            return await repository.delete_user(session, user)
+
+    blobs = run(scenario())
+    db.expire_all()
+    return blobs
+
+
+def test_delete_user_removes_what_they_own(db):
+    owner = make_user(db, "owner@example.com")
+    consultant = make_user(db, "fixer@example.com", "serviceman")
+    prop = make_property(db, owner)
+    db.add_all(
+        [
+            models.Document(
+                user_id=owner.user_id,
+                pdf_id="a" * 32,
+                filename="bill.pdf",
+                sha256="b" * 64,
+                size=1,
+            ),
+            models.EnergyCalculation(
+                user_id=owner.user_id,
+                property_id=prop.property_id,
+                energy_consumption=1000,
+                date=SLOT,
+            ),
+            models.Consultation(
+                property_id=prop.property_id,
+                consultant_id=consultant.user_id,
+                consultation_date=SLOT,
+                active_slot=SLOT,
+                status="scheduled",
+            ),
+            models.CustomerTicket(
+                user_id=owner.user_id,
+                assigned_to=consultant.user_id,
+                category="Technical",
+                subject="Broken",
+                description="Panel",
+                status="open",
+                priority="low",
+            ),
+        ]
+    )
+    db.commit()
+
+    owner_id, consultant_id = owner.user_id, consultant.user_id
+    assert delete_user(db, owner_id) == ["b" * 64]
+    for model in (
+        models.Document,
+        models.Property,
+        models.EnergyCalculation,
+        models.Consultation,
+        models.CustomerTicket,
+    ):
+        assert count(db, model) == 0, model
+    rollup = db.get(models.CalculationRollup, ("user", owner_id, "day", SLOT.date()))
+    assert float(rollup.energy_consumption) == 0 and rollup.energy_count == 0
+    assert db.get(models.User, consultant_id) is not None
+
+
+def test_delete_staff_keeps_history_and_cancels_bookings(db):
+    owner = make_user(db, "owner@example.com")
+    consultant = make_user(db, "fixer@example.com", "serviceman")
+    prop = make_property(db, owner)
+    booking = models.Consultation(
+        property_id=prop.property_id,
+        consultant_id=consultant.user_id,
+        consultation_date=SLOT,
+        active_slot=SLOT,
+        status="scheduled",
+    )
+    ticket = models.CustomerTicket(
+        user_id=owner.user_id,
+        assigned_to=consultant.user_id,
+        category="Billing",
+        subject="Invoice",
+        description="Twice",
+        status="in_progress",
+        priority="low",
+    )
+    db.add_all([booking, ticket])
+    db.commit()
+
+    owner_id, consultant_id = owner.user_id, consultant.user_id
+    delete_user(db, consultant_id)
+    assert db.get(models.User, consultant_id) is None
+    assert (booking.consultant_id, booking.active_slot) == (None, None)
+    assert booking.status == "cancelled"
+    assert ticket.assigned_to is None and ticket.user_id == owner_id
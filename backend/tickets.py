@@ -0,0 +1,135 @@
+import asyncio
+import datetime
+import heapq
+import os
+import threading
+from typing import Awaitable, Callable, Iterable, List, Optional, Set, Tuple
+
+from logger import get_logger
+
+log = get_logger("tickets")
+
+# Open tickets wait in a heap ordered by (priority rank, created_at, id), so
+# a claim pops the next candidate in O(log n) whatever the backlog. Tickets
+# that stop being open are dropped lazily when they reach the top.
+PRIORITY_RANK = {"urgent": 0, "high": 1, "medium": 2, "low": 3}
+# How often tickets created by other worker processes are pulled in
+TICKET_REFRESH_INTERVAL = float(os.getenv("TICKET_REFRESH_INTERVAL", "5"))
+# created_at is stamped before the insert commits, so a refresh looks this far
+# back past the newest ticket it has seen to catch slower commits
+TICKET_REFRESH_OVERLAP = datetime.timedelta(
+    seconds=float(os.getenv("TICKET_REFRESH_OVERLAP", "60"))
+)
+
+TicketRow = Tuple[int, str, datetime.datetime]  # ticket_id, priority, created_at
+# Open tickets created at or after the given time, all of them for None
+Fetch = Callable[[Optional[datetime.datetime]], Awaitable[List[TicketRow]]]
+
+
+class TicketQueue:
+    def __init__(self):
+        self._heap: List[tuple] = []
+        self._queued: Set[int] = set()
+        self._lock = threading.Lock()
+        self._task = None
+        # Newest created_at read from the database. Local pushes don't move
+        # it, ids and times from this worker say nothing about what other
+        # workers have committed
+        self.seen_until: Optional[datetime.datetime] = None
+        self.claims = 0
+        self.stale = 0
+
+    @staticmethod
+    def _entry(ticket_id: int, priority: str, created_at) -> tuple:
+        created_at = created_at or datetime.datetime.min
+        return (PRIORITY_RANK.get(priority, len(PRIORITY_RANK)), created_at, ticket_id)
+
+    def _advance(self, rows: List[TicketRow]):
+        latest = max((row[2] for row in rows if row[2] is not None), default=None)
+        with self._lock:
+            if latest is not None and (
+                self.seen_until is None or latest > self.seen_until
+            ):
+                self.seen_until = latest
+
+    def load(self, rows: Iterable[TicketRow]):
+        rows = list(rows)
+        heap = [self._entry(*row) for row in rows]
+        heapq.heapify(heap)
+        with self._lock:
+            self._heap = heap
+            self._queued = {entry[2] for entry in heap}
+        self._advance(rows)
+
+    def push(self, ticket_id: int, priority: str, created_at):
+        with self._lock:
+            if ticket_id in self._queued:
+                return
+            heapq.heappush(self._heap, self._entry(ticket_id, priority, created_at))
+            self._queued.add(ticket_id)
+
+    def extend(self, rows: Iterable[TicketRow]):
+        for row in rows:
+            self.push(*row)
+
+    def discard(self, ticket_id: int):
+        # The heap entry stays until it's popped and skipped
+        with self._lock:
+            self._queued.discard(ticket_id)
+
+    def pop(self) -> Optional[tuple]:
+        """Next (rank, created_at, ticket_id) entry, handed to one caller only."""
+        with self._lock:
+            while self._heap:
+                entry = heapq.heappop(self._heap)
+                if entry[2] in self._queued:
+                    self._queued.discard(entry[2])
+                    return entry
+            return None
+
+    def requeue(self, entry: tuple):
+        # A claim that failed before reaching the database gives it back
+        with self._lock:
+            if entry[2] not in self._queued:
+                heapq.heappush(self._heap, entry)
+                self._queued.add(entry[2])
+
+    def __len__(self) -> int:
+        return len(self._queued)
+
+    async def refresh(self, fetch: Fetch):
+        """Queue open tickets created since the last refresh, less the overlap.
+
+        Tickets already queued are skipped by push, ones claimed since are no
+        longer open and aren't returned."""
+        since = self.seen_until
+        if since is not None:
+            since -= TICKET_REFRESH_OVERLAP
+        rows = await fetch(since)
+        self.extend(rows)
+        self._advance(rows)
+
+    async def _maintain(self, fetch: Fetch):
+        while True:
+            await asyncio.sleep(TICKET_REFRESH_INTERVAL)
+            try:
+                await self.refresh(fetch)
+            except Exception:
+                log.exception("Refreshing the ticket queue failed")
+
+    def start(self, fetch: Fetch):
+        self._task = asyncio.get_running_loop().create_task(self._maintain(fetch))
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "queued": len(self._queued),
+                "heap_entries": len(self._heap),
+                "claims": self.claims,
+                "stale_pops": self.stale,
+            }
@@ -24,6 +24,7 @@ import { useNavigate } from 'react-router-dom';
 function Dashboard() {
   const [pdfs, setPdfs] = useState([]);
   const [selectedPdf, setSelectedPdf] = useState(null);
+  const [nextCursor, setNextCursor] = useState(null);
   const { user, logout } = useAuth();
   const navigate = useNavigate();
 
@@ -35,14 +36,18 @@ function Dashboard() {
     }
   }, [user, navigate]);
 
-  const fetchPdfs = async () => {
+  // Loads the first page, or the page after `cursor` appended to the list
+  const fetchPdfs = async (cursor = null) => {
     try {
       const token = localStorage.getItem('token');
       const response = await axios.get('http://localhost:8000/pdfs', {
-        headers: { Authorization: `Bearer ${token}` }
+        headers: { Authorization: `Bearer ${token}` },
+        params: cursor ? { cursor } : {}
       });
       if (response.status === 200) {
-        setPdfs(response.data || []);
+        const page = response.data || [];
+        setPdfs((current) => (cursor ? [...current, ...page] : page));
+        setNextCursor(response.headers['x-next-cursor'] || null);
       } else {
         alert('Failed to fetch pdfs');
       }
@@ -52,33 +57,55 @@ function Dashboard() {
   };
 
   const handleFileUpload = async (e) => {
-    const file = e.target.files[0];
-    if (!file) {
+    const files = Array.from(e.target.files);
+    if (files.length === 0) {
       return;
     }
     try {
+      // Several files go up in one request to the batch endpoint
       const formData = new FormData();
-      formData.append('file', file);
+      files.forEach((file) => formData.append(files.length > 1 ? 'files' : 'file', file));
       const token = localStorage.getItem('token');
-      await axios.post('http://localhost:8000/upload-pdf', formData, {
-        headers: { 
-          Authorization: `Bearer ${token}`,
-          'Content-Type': 'multipart/form-data'
+      const response = await axios.post(
+        files.length > 1 ? 'http://localhost:8000/upload-pdfs' : 'http://localhost:8000/upload-pdf',
+        formData,
+        {
+          headers: {
+            Authorization: `Bearer ${token}`,
+            'Content-Type': 'multipart/form-data'
+          }
         }
-      });
+      );
+      if (files.length > 1 && response.data.failed > 0) {
+        const failed = response.data.results
+          .filter((result) => result.status !== 'ok')
+          .map((result) => `${result.filename}: ${result.detail}`);
+        alert(`Some PDFs failed to upload:\n${failed.join('\n')}`);
+      }
       fetchPdfs();
     } catch (error) {
       alert(`Failed to upload PDF: ${error.message}`);
     }
+    e.target.value = '';
   };
 
   const viewPdf = async (pdfId) => {
     try {
       const token = localStorage.getItem('token');
-      const response = await axios.get(`http://localhost:8000/pdf/${pdfId}`, {
-        headers: { Authorization: `Bearer ${token}` }
+      // Raw bytes instead of a base64 JSON body, the browser gets a blob URL
+      const response = await axios.get(`http://localhost:8000/pdf/${pdfId}/raw`, {
+        headers: { Authorization: `Bearer ${token}` },
+        responseType: 'blob'
+      });
+      const pdf = pdfs.find((p) => p.pdf_id === pdfId);
+      if (selectedPdf) {
+        URL.revokeObjectURL(selectedPdf.url);
+      }
+      setSelectedPdf({
+        pdf_id: pdfId,
+        filename: pdf ? pdf.filename : pdfId,
+        url: URL.createObjectURL(response.data)
       });
-      setSelectedPdf(response.data);
     } catch (error) {
       alert(`Failed to view PDF: ${error.message}`);
     }
@@ -131,6 +158,7 @@ function Dashboard() {
               <input
                 type="file"
                 accept=".pdf"
+                multiple
                 id="pdf-upload"
                 onChange={handleFileUpload}
                 style={{ display: 'none' }}
@@ -199,6 +227,11 @@ function Dashboard() {
                     </ListItem>
                   </Paper>
                 ))}
+                {nextCursor && (
+                  <Button fullWidth onClick={() => fetchPdfs(nextCursor)}>
+                    Load more
+                  </Button>
+                )}
               </List>
             )}
           </Paper>
@@ -229,7 +262,7 @@ function Dashboard() {
                   }}
                 >
                   <embed
-                    src={`data:application/pdf;base64,${selectedPdf.content}`}
+                    src={selectedPdf.url}
                     type="application/pdf"
                     width="100%"
                     height="100%"